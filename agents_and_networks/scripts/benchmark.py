@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from shapely.geometry import Point
+
+from src.cell.sampling import read_trajectory
+from src.model.model import AgentsAndNetworks
+from utils.synthetic import write_region
+
+
+"""
+Benchmark suite for the trajectory and cell tower sampling pipelines on synthetic regions. Results are
+written as JSON and can be compared against a stored baseline to catch throughput regressions.
+"""
+
+START_DATE = "2023-05-01"
+PATH_CACHE_FILE = "outputs/path_cache_result.pkl"
+NUM_QUERIES = 200
+
+
+def measure(results: list, name: str, blocks: int, agents: int, count: int, func):
+    start = time.perf_counter()
+    out = func()
+    seconds = time.perf_counter() - start
+    results.append(
+        {
+            "name": name,
+            "blocks": blocks,
+            "agents": agents,
+            "count": count,
+            "seconds": seconds,
+            "throughput": count / seconds if seconds > 0 else float("inf"),
+        }
+    )
+    print(f"{name:<20} blocks={blocks:<5} agents={agents:<7} {count / seconds:>12.1f}/s")
+    return out
+
+
+def run_region(results: list, blocks: int, agents: int, ticks: int, seed: int) -> None:
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    region = write_region("data", blocks, seed=seed)
+
+    model = measure(results, "construct", blocks, agents, 1, lambda: AgentsAndNetworks(
+        data_crs="epsg:4326",
+        buildings_file=region["buildings_file"],
+        walkway_file=region["walkway_file"],
+        output_file="output_trajectory.csv",
+        num_commuters=agents,
+        step_duration=60,
+        alpha=0.55,
+        tau_jump=100.0,
+        tau_jump_min=1.0,
+        beta=0.8,
+        tau_time=17,
+        tau_time_min=0.33,
+        rho=1,
+        gamma=2,
+        bounding_box=region["bounding_box"],
+        commuter_speed_walk=1.4,
+        start_date=START_DATE,
+    ))
+    model.random.seed(seed)
+
+    def step():
+        for _ in range(ticks):
+            model.step()
+        model.flush()
+
+    measure(results, "step", blocks, agents, ticks * agents, step)
+
+    nodes = list(model.walkway.nx_graph.nodes)
+    pairs = [(nodes[i], nodes[j]) for i, j in rng.integers(0, len(nodes), (NUM_QUERIES, 2))]
+    measure(results, "shortest_path", blocks, agents, len(pairs),
+            lambda: [model.walkway.get_shortest_path(source, target) for source, target in pairs])
+
+    bounding_box = model.space.total_bounds
+    points = rng.uniform(bounding_box[:2], bounding_box[2:], (NUM_QUERIES, 2))
+    measure(results, "nearest_building", blocks, agents, len(points),
+            lambda: [model.space.get_nearest_building(Point(point), model.space.new_visited_set()) for point in points])
+
+    from run_cell.coverage import load_sampler as load_coverage_sampler
+    from run_cell.simple import load_sampler as load_simple_sampler
+
+    end_date = (model.start_date + timedelta(days=model.day + 1)).strftime("%Y-%m-%d")
+    trajectory = read_trajectory("output_trajectory.csv", START_DATE, end_date)
+    params = {
+        "start_date": START_DATE,
+        "end_date": end_date,
+        "bounding_box": region["bounding_box"],
+        "cell_file": region["cell_file"],
+        "coverage_file": region["coverage_file"],
+        "sampling_method": 1,
+    }
+    for name, load_sampler in (("simple", load_simple_sampler), ("coverage", load_coverage_sampler)):
+        sampler = load_sampler(params)
+        measure(results, f"sample_{name}", blocks, agents, len(trajectory),
+                lambda: sampler.sample(trajectory))
+
+
+def compare(results: list, baseline: list, tolerance: float) -> bool:
+    """Print the throughput relative to the baseline, return whether nothing regressed."""
+    baseline = {(r["name"], r["blocks"], r["agents"]): r for r in baseline}
+    passed = True
+    for result in results:
+        key = (result["name"], result["blocks"], result["agents"])
+        if key not in baseline:
+            continue
+        ratio = result["throughput"] / baseline[key]["throughput"]
+        regressed = ratio < 1 - tolerance
+        passed &= not regressed
+        print(f"{key[0]:<20} blocks={key[1]:<5} agents={key[2]:<7} {ratio:>6.2f}x"
+              + ("  REGRESSION" if regressed else ""))
+    return passed
+
+
+def main(args) -> bool:
+    results = []
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        # throughput depends on the run length and the region, only compare like with like
+        for field in ("ticks", "seed"):
+            if baseline["meta"].get(field) != getattr(args, field):
+                raise ValueError(
+                    f"baseline was run with {field}={baseline['meta'].get(field)}, "
+                    f"not {getattr(args, field)}"
+                )
+    with tempfile.TemporaryDirectory() as directory:
+        # the model caches paths in outputs/, keep it away from real runs
+        cwd = os.getcwd()
+        os.chdir(directory)
+        os.mkdir("outputs")
+        try:
+            for blocks in args.blocks:
+                for agents in args.agents:
+                    # every run starts without cached paths
+                    if os.path.exists(PATH_CACHE_FILE):
+                        os.remove(PATH_CACHE_FILE)
+                    run_region(results, blocks, agents, args.ticks, args.seed)
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as output_file:
+        json.dump({
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "ticks": args.ticks,
+                "seed": args.seed,
+            },
+            "results": results,
+        }, output_file, indent=2)
+
+    if baseline is None:
+        return True
+    return compare(results, baseline["results"], args.tolerance)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the trajectory and cell tower sampling pipelines on synthetic regions."
+    )
+    parser.add_argument("--agents", type=int, nargs="+", default=[10, 100],
+                        help="numbers of agents to benchmark, e.g. 10 100 1000 100000")
+    parser.add_argument("--blocks", type=int, nargs="+", default=[10, 30],
+                        help="region sizes, as the number of grid blocks per side")
+    parser.add_argument("--ticks", type=int, default=1440, help="number of model steps per run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="outputs/benchmark.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative throughput drop that counts as a regression")
+    sys.exit(0 if main(parser.parse_args()) else 1)
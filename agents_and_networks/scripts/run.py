@@ -8,6 +8,8 @@ from src.visualization.server import (
     status_chart,
     location_chart,
 )
+from src.visualization.async_server import AsyncModularServer
+from src.visualization.streaming import CommuterMapModule
 
 
 if __name__ == "__main__":
@@ -31,6 +33,14 @@ if __name__ == "__main__":
             "Step duration (seconds)",
             value=60,
         ),
+        "adaptive": mesa.visualization.Checkbox(
+            "Adaptive steps (exact trip timestamps for any step duration)",
+            value=False,
+        ),
+        "output_resolution": mesa.visualization.NumberInput(
+            "Path vertex interval in adaptive mode (seconds)",
+            value=60,
+        ),
         "alpha": mesa.visualization.NumberInput(
             "Exponent travel distance distribution (truncated power law)",
             value=0.55,
@@ -68,13 +78,19 @@ if __name__ == "__main__":
         "output_file": OUTPUT_TRAJECTORY_FILE,
     }
 
-    map_element = mg.visualization.MapModule(agent_draw, map_height=600, map_width=600)
-    server = mesa.visualization.ModularServer(
+    # streams only changed commuters each frame, clustered above max_commuters
+    map_element = CommuterMapModule(map_height=600, map_width=600, max_commuters=2000)
+    # full GeoJSON of every agent each frame
+    # map_element = mg.visualization.MapModule(agent_draw, map_height=600, map_width=600)
+    # the model runs in a background thread, the page gets frame_rate snapshots per second;
+    # mesa.visualization.ModularServer steps the model once per frame instead
+    server = AsyncModularServer(
         AgentsAndNetworks,
         # use following if you want map functionality
         [map_element, clock_element],
         # [clock_element],
         "Mesa Mobility extended with EPR",
         model_params,
+        frame_rate=10,
     )
     server.launch()
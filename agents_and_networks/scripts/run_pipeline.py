@@ -0,0 +1,161 @@
+import queue
+import threading
+from datetime import datetime, timedelta
+
+from config import BOUNDING_BOX, START_DATE, END_DATE, BUILDING_FILE, STREET_FILE, OUTPUT_TRAJECTORY_FILE, OUTPUT_CELL_FILE, CELL_FILE, COVERAGE_FILE
+from src.cell.sampling import trajectory_from_rows
+from src.metrics import METRICS
+from src.model.model import AgentsAndNetworks
+from src.store import RowWriter
+
+
+"""
+Script to run the trajectory model and the cell tower sampling in a single pass. Trajectory rows
+are streamed from the model into the sampler through a bounded queue, so the trajectory file is
+optional and does not have to be read back in.
+"""
+def main(model_params, sampler_params):
+    start = datetime.strptime(model_params["start_date"], "%Y-%m-%d")
+    end = datetime.strptime(sampler_params["end_date"], "%Y-%m-%d")
+
+    if sampler_params["sampler"] == "coverage":
+        from run_cell.coverage import load_sampler, open_writer
+    else:
+        from run_cell.simple import load_sampler
+
+        def open_writer(sampler, sampler_params, truncate_at=None):
+            return RowWriter(sampler_params["output_file"], "cell", ['id', *sampler.HEADER], truncate_at)
+    sampler = load_sampler(sampler_params)
+
+    # the model blocks once the sampler falls too many flushes behind
+    rows_queue = queue.Queue(maxsize=sampler_params["queue_size"])
+
+    # the error the sampler stopped on, raised again in the main thread
+    failures = []
+
+    def sample_rows() -> None:
+        try:
+            output_writer = open_writer(sampler, sampler_params, truncate_at)
+            try:
+                writing_id = output_writer.next_id
+                while (rows := rows_queue.get()) is not None:
+                    cell_rows = sampler.sample(trajectory_from_rows(rows))
+                    output_writer.writerows([writing_id + i, *row] for i, row in enumerate(cell_rows))
+                    writing_id += len(cell_rows)
+            finally:
+                output_writer.close()
+        except BaseException as error:
+            failures.append(error)
+
+    def put_rows(rows) -> None:
+        # a failed sampler no longer empties the queue, stop instead of blocking on it
+        while consumer.is_alive():
+            try:
+                rows_queue.put(rows, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("cell sampling stopped") from (failures[0] if failures else None)
+
+    consumer = threading.Thread(target=sample_rows)
+    model = AgentsAndNetworks(**model_params, trajectory_sink=put_rows)
+    truncate_at = None
+    if model_params["resume_from"] is not None:
+        # keep the cell events before the checkpoint and continue sampling from it
+        truncate_at = str(start + timedelta(seconds=model.clock))
+        # the sampler continues from where the commuters were and the homes they started from
+        sampler.start_at(model.clock, *model.get_written_positions())
+    consumer.start()
+
+    try:
+        # a resumed model continues from its checkpointed clock
+        num_steps = int((end - start).total_seconds() - model.clock) // model_params["step_duration"]
+        for _ in range(num_steps):
+            model.step()
+        model.flush()
+        if sampler_params["visitation_state_file"] is not None:
+            model.save_visitation_state(sampler_params["visitation_state_file"])
+    finally:
+        try:
+            put_rows(None)
+        except RuntimeError:
+            pass
+        consumer.join()
+        if METRICS.enabled:
+            print(METRICS.summary())
+            METRICS.close()
+        if hasattr(sampler, "summary"):
+            print(sampler.summary())
+        if failures:
+            raise failures[0]
+
+
+if __name__ == "__main__":
+    model_params = {
+        "data_crs": "epsg:4326",
+        "start_date": START_DATE,
+        "bounding_box": BOUNDING_BOX,
+        "num_commuters": 10,
+        "commuter_speed_walk": 1.4,
+        "step_duration": 60,
+        # with adaptive steps, step_duration can be raised to e.g. 3600 without coarsening
+        # the trajectory, path vertices stay output_resolution seconds apart
+        "adaptive": False,
+        "output_resolution": 60,
+        # set to a file to time the hot paths per simulated hour ("jsonl" or "prometheus")
+        "metrics_file": None,
+        "metrics_format": "jsonl",
+        # GeoPackage with the buildings and roads of the bounding box, written on the first run
+        "region_snapshot": None,
+        # periodic checkpoints of the trajectory model, every checkpoint_interval simulated hours.
+        # A resumed run appends to the trajectory and cell files, dropping what was written after the checkpoint.
+        "checkpoint_file": None,
+        "checkpoint_interval": 24,
+        "resume_from": None,
+        # start commuters from the visitation state saved at the end of a burn-in run
+        "warm_start_file": None,
+        # route between all building entrances up front, for compact bounding boxes
+        "precompute_paths": False,
+        # read the region in overlapping tiles of tile_size meters, keeping max_tiles in memory
+        "tile_size": None,
+        "tile_overlap": 1000,
+        "max_tiles": 9,
+        # nearest buildings by footprint; with False by centroid, so the footprints are never loaded
+        "footprint_distance": True,
+        "alpha": 0.55,
+        "tau_jump_min": 1.0,
+        "tau_jump": 100.0,
+        "beta": 0.8,
+        "tau_time_min": 0.33,
+        "tau_time": 17,
+        "rho": 1,
+        "gamma": 2,
+        "buildings_file": BUILDING_FILE,
+        "walkway_file": STREET_FILE,
+        # set to None to skip writing the intermediate trajectory file
+        "output_file": OUTPUT_TRAJECTORY_FILE,
+    }
+
+    sampler_params = {
+        # "simple" for the closest facing cell tower, "coverage" for the coverage model
+        "sampler": "simple",
+        "start_date": START_DATE,
+        "end_date": END_DATE,
+        "bounding_box": BOUNDING_BOX,
+        "cell_file": CELL_FILE,
+        "coverage_file": COVERAGE_FILE,
+        "output_file": OUTPUT_CELL_FILE,
+        # 1 for independent sampling, 2 for dependent on time and 3 for dependent on location
+        "sampling_method": 1,
+        # (mnc, technology) of every coverage model, sampled in a single pass over the trajectories
+        "models": [('16', 'LTE')],
+        # with several models, write a single output with a model column instead of one output per model
+        "combined_output": False,
+        # number of 100m cells of which the coverage sampler keeps the antenna distribution per model
+        "max_cached_cells": 100000,
+        # maximum number of hourly trajectory flushes waiting to be sampled
+        "queue_size": 24,
+        # save the visitation state at the end of the run, e.g. of a burn-in run for warm starts
+        "visitation_state_file": None,
+    }
+    main(model_params, sampler_params)
@@ -1,10 +1,22 @@
+import argparse
 from pathlib import Path
 
-import pandas as pd
-import folium
 import branca
-from branca.element import Element
+import folium
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
 
+from src.store import read_table
+
+
+"""
+Folium map of the trajectories of some agents over some date ranges: one time-colored line per agent
+and date range, simplified with Douglas-Peucker, and the stops as a single GeoJSON layer of circles
+sized by the stop duration.
+
+python3 scripts/utils/mapit.py --data outputs/output_trajectory.csv --agents Agent2 Agent5 --dates 2023-06-04/2023-06-05
+"""
 
 ## Baseline Param
 data_path = Path('././outputs/trajectories2.0/Returners/Eval/output_trajectory.csv')
@@ -52,70 +64,134 @@ agents = ["Agent2"]
 
 # agents = ["Agent16"]
 
-df = pd.read_csv(data_path)
-
-mask = (df['timestamp'] >= start_date) & (df['timestamp'] <= end_date)
-df = df.loc[mask]
-mask = (df['owner'].isin(agents)) 
-df = df.loc[mask]
-
-
-for date_col in ['timestamp']:
-    df[date_col] = pd.to_datetime(df[date_col])
-df = df.sort_values('timestamp')
-df = df.rename(columns={"cellinfo.wgs84.lon": "longitude", "cellinfo.wgs84.lat": "latitude"})
-
-m = folium.Map(location=(df.latitude.mean(), df.longitude.mean()),
-               tiles='CartoDB positron',zoom_start=11, control_scale=True)
-
-print(df.timestamp.min())
-print(df.timestamp.max())
-
-
-df['timestamp_seconds'] = (df['timestamp'] - df['timestamp'].min()).dt.total_seconds()
-
-colorscale = branca.colormap.LinearColormap(
-    colors=['red','yellow','green'],
-    vmin=df['timestamp_seconds'].min(),
-    vmax=df['timestamp_seconds'].max()
-).to_step(n=200)
-
-points = []
-colors = []  # List to hold colors based on timestam
-status_previous = ""
-timestamp_previous = 0
-lat_previous = 0
-long_previous = 0
-for _, report in df.iterrows():
-    points.append((report.latitude, report.longitude))
-    colors.append(report.timestamp_seconds)  # Use normalized timestamp for color\
-    if(status_previous != "transport"):
-        folium.Circle(
-            location=(lat_previous, long_previous),
-            fill=True,
-            fill_opacity=0.5,
-            radius = (report.timestamp_seconds - timestamp_previous)/100,
-            color = colorscale(report.timestamp_seconds),
+# Douglas-Peucker tolerance of the transport lines, in meters
+tolerance = 10
+
+_to_rd = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True)
+
+
+def read_trajectories(path, agents, date_ranges) -> pd.DataFrame:
+    """Rows of the given agents within any of the (start, end) date ranges, from a csv file or store."""
+    df = read_table(path, "trajectory", agents, date_ranges)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='ISO8601')
+    df = df.rename(columns={"cellinfo.wgs84.lon": "longitude", "cellinfo.wgs84.lat": "latitude"})
+    return df.sort_values(['owner', 'timestamp'], kind='stable')
+
+
+def douglas_peucker(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """Mask of the points kept by Douglas-Peucker simplification with the given tolerance."""
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+        farthest = np.argmax(distances)
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.extend([(first, middle), (middle, last)])
+    return keep
+
+
+def get_stops(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Stops of every track: a row after a non-transport row closes a stay at the previous location,
+    its duration is the time between both rows.
+    """
+    previous = df.groupby('track')[['status', 'latitude', 'longitude', 'timestamp_seconds']].shift()
+    stops = df.assign(
+        latitude=previous['latitude'],
+        longitude=previous['longitude'],
+        duration=df['timestamp_seconds'] - previous['timestamp_seconds'],
+    )
+    return stops.loc[previous['status'].notna() & (previous['status'] != "transport")]
+
+
+def main(data_path, agents, date_ranges, tolerance, output):
+    df = read_trajectories(data_path, agents, date_ranges)
+    print(df.timestamp.min())
+    print(df.timestamp.max())
+
+    # one track per agent and date range
+    df['track'] = df['owner']
+    for i, (start, end) in enumerate(date_ranges):
+        in_range = (df['timestamp'] >= start) & (df['timestamp'] <= end)
+        df.loc[in_range, 'track'] = df.loc[in_range, 'owner'] + f"/{i}"
+    df['timestamp_seconds'] = (df['timestamp'] - df['timestamp'].min()).dt.total_seconds()
+
+    m = folium.Map(location=(df.latitude.mean(), df.longitude.mean()),
+                   tiles='CartoDB positron', zoom_start=11, control_scale=True)
+    colorscale = branca.colormap.LinearColormap(
+        colors=['red', 'yellow', 'green'],
+        vmin=df['timestamp_seconds'].min(),
+        vmax=df['timestamp_seconds'].max()
+    ).to_step(n=200)
+
+    stops = get_stops(df)
+    folium.GeoJson(
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+                    "properties": {"radius": duration / 100, "color": colorscale(seconds), "owner": owner},
+                }
+                for longitude, latitude, duration, seconds, owner in zip(
+                    stops['longitude'], stops['latitude'], stops['duration'],
+                    stops['timestamp_seconds'], stops['owner'],
+                )
+            ],
+        },
+        name="stops",
+        marker=folium.Circle(fill=True, fill_opacity=0.5),
+        style_function=lambda feature: {
+            "radius": feature["properties"]["radius"],
+            "color": feature["properties"]["color"],
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["owner"]),
+    ).add_to(m)
+
+    x, y = _to_rd.transform(df['longitude'].to_numpy(), df['latitude'].to_numpy())
+    for _, track in df.groupby('track', sort=False).indices.items():
+        keep = track[douglas_peucker(x[track], y[track], tolerance)]
+        if len(keep) < 2:
+            continue
+        folium.ColorLine(
+            positions=df[['latitude', 'longitude']].to_numpy()[keep].tolist(),
+            colors=df['timestamp_seconds'].to_numpy()[keep].tolist(),  # Use the normalized timestamp values for colors
+            colormap=colorscale,  # Use the defined colorscale
+            weight=2.5,
+            opacity=1
         ).add_to(m)
-        # print(report.timestamp_seconds - timestamp_previous)
-    status_previous = report.status
-    timestamp_previous = report.timestamp_seconds
-    lat_previous = report.latitude
-    long_previous = report.longitude
-
-
-
-folium.ColorLine(
-    positions=points,
-    colors=colors,  # Use the normalized timestamp values for colors
-    colormap=colorscale,  # Use the defined colorscale
-    weight=2.5,
-    opacity=1
-).add_to(m)
-
-
-
-m.save(f'./{data_path.stem}.html')
-
-
 
+    m.save(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map trajectories of agents with folium.")
+    parser.add_argument("--data", type=Path, default=data_path, help="trajectory csv file or store")
+    parser.add_argument("--agents", nargs="+", default=agents)
+    parser.add_argument("--dates", nargs="+", default=[f"{start_date}/{end_date}"],
+                        help="date ranges as start/end, e.g. 2023-06-04/2023-06-05")
+    parser.add_argument("--tolerance", type=float, default=tolerance,
+                        help="simplification tolerance of the lines, in meters")
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    main(
+        args.data,
+        args.agents,
+        [tuple(dates.split("/")) for dates in args.dates],
+        args.tolerance,
+        args.output or f'./{args.data.stem}.html',
+    )
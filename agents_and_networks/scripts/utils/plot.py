@@ -1,9 +1,24 @@
-import matplotlib.pyplot as plt
+import argparse
+import os
+
+import matplotlib
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import re
+from matplotlib.collections import LineCollection
+
+from src.space.region import load_region_snapshot
+from src.store import read_table
+from config import BOUNDING_BOX, BOUNDING_INCREASE, START_DATE, END_DATE, OUTPUT_TRAJECTORY_FILE, OUTPUT_CELL_FILE, STREET_FILE
+
+
+"""
+Plot the trajectories next to the cell towers each phone connected to. Every panel is drawn with
+one LineCollection and one scatter call for all agents; above raster_above agents, the points are
+aggregated into a 2-D histogram instead.
 
-from config import BOUNDING_BOX, BOUNDING_INCREASE, START_DATE, END_DATE, OUTPUT_TRAJECTORY_FILE, OUTPUT_CELL_FILE, CELL_FILE, STREET_FILE
+python3 scripts/utils/plot.py --output outputs/plot.png
+"""
 
 # Start and End date for trajectory analysis
 start_date = START_DATE
@@ -12,54 +27,92 @@ end_date = END_DATE
 # Expand bounding box size
 increase = BOUNDING_INCREASE
 
-df_cell = pd.read_csv(OUTPUT_CELL_FILE)
-df_trajectory = pd.read_csv(OUTPUT_TRAJECTORY_FILE)
+# Number of agents above which panels show point density instead of lines
+raster_above = 100
 
-mask = (df_trajectory['timestamp'] >= start_date) & (df_trajectory['timestamp'] <= end_date)
-df_trajectory = df_trajectory.loc[mask]
-mask = (df_cell['timestamp'] >= start_date) & (df_cell['timestamp'] <= end_date)
-df_cell = df_cell.loc[mask]
 
+def read_roads(region_snapshot, bounding_box) -> gpd.GeoDataFrame:
+    # the roads of a region snapshot are in the model crs
+    if region_snapshot is not None and os.path.exists(region_snapshot):
+        _, walkway_df = load_region_snapshot(region_snapshot, footprints=False)
+        return walkway_df.to_crs("epsg:4326")
+    return gpd.read_file(STREET_FILE, bbox=bounding_box)
 
-bounding_box = (BOUNDING_BOX[0] - increase, BOUNDING_BOX[1] - increase, BOUNDING_BOX[2] + increase, BOUNDING_BOX[3] + increase)
-
-walkway_file = STREET_FILE
-
-fig, (ax1,ax2,ax3) = plt.subplots(1,3)
-walkway_df = (
-            gpd.read_file(walkway_file, bounding_box)
-        )
-
-walkway_df.plot(ax=ax1,color='black',linewidth=0.5)
-walkway_df.plot(ax=ax2,color='black',linewidth=0.5)
-walkway_df.plot(ax=ax3,color='black',linewidth=0.5)
 
-agents = sorted(pd.unique(df_cell['owner']))
+def get_tracks(df: pd.DataFrame, key: str) -> tuple[list[np.ndarray], np.ndarray]:
+    """Lon/lat arrays per value of key, in file order, and the code of every row's value."""
+    codes, _ = pd.factorize(df[key], sort=True)
+    order = np.argsort(codes, kind="stable")
+    points = df[['cellinfo.wgs84.lon', 'cellinfo.wgs84.lat']].to_numpy()[order]
+    splits = np.flatnonzero(np.diff(codes[order])) + 1
+    return np.split(points, splits), codes
 
-for i in range(len(agents)):
-    agents_cell = df_cell[df_cell['owner'].isin([agents[i]])] 
-    agents_trajectory = df_trajectory[df_trajectory['owner'].isin([agents[i]])] 
 
-    lon = agents_trajectory['cellinfo.wgs84.lon']
-    lat = agents_trajectory['cellinfo.wgs84.lat']
-    ax1.plot(lon, lat, zorder=5)
-    ax1.scatter(lon, lat, zorder=10)
-    ax1.set_title('Trajectory')
-
-    phone1_df = agents_cell[agents_cell['device'].isin([re.sub("[^0-9]", "", agents[i])+"_1"])] 
-    phone2_df = agents_cell[agents_cell['device'].isin([re.sub("[^0-9]", "", agents[i])+"_2"])] 
-
-
-    lon1 = phone1_df['cellinfo.wgs84.lon']
-    lat1 = phone1_df['cellinfo.wgs84.lat']
-    lon2 = phone2_df['cellinfo.wgs84.lon']
-    lat2 = phone2_df['cellinfo.wgs84.lat']
-
-    ax2.plot(lon1, lat1, zorder=10)
-    ax2.scatter(lon1, lat1, zorder=10)
-    ax2.set_title('Cell Towers: Phone 1')
-    ax3.plot(lon2, lat2, zorder=10)
-    ax3.scatter(lon2, lat2, zorder=10)
-    ax3.set_title('Cell Towers: Phone 2')
-
-plt.show()
\ No newline at end of file
+def draw(ax, df, key, title, raster, bins, bounding_box) -> None:
+    ax.set_title(title)
+    if len(df) == 0:
+        return
+    if raster:
+        counts, x_edges, y_edges = np.histogram2d(
+            df['cellinfo.wgs84.lon'], df['cellinfo.wgs84.lat'], bins=bins,
+            range=[[bounding_box[0], bounding_box[2]], [bounding_box[1], bounding_box[3]]],
+        )
+        ax.imshow(
+            # empty cells stay transparent over the roads
+            np.ma.masked_equal(np.log1p(counts.T), 0), origin="lower", cmap="viridis", zorder=5, alpha=0.8,
+            extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), aspect="auto",
+        )
+        return
+    tracks, codes = get_tracks(df, key)
+    colors = matplotlib.colormaps["tab20"](np.arange(len(tracks)) % 20)
+    ax.add_collection(LineCollection(tracks, colors=colors, zorder=5))
+    ax.scatter(df['cellinfo.wgs84.lon'], df['cellinfo.wgs84.lat'], c=colors[codes], s=4, zorder=10)
+
+
+def main(trajectory_file, cell_file, start_date, end_date, region_snapshot, raster_above, bins, output):
+    if output is not None:
+        # write to a file without a display
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    bounding_box = (BOUNDING_BOX[0] - increase, BOUNDING_BOX[1] - increase, BOUNDING_BOX[2] + increase, BOUNDING_BOX[3] + increase)
+
+    # csv files or stores, only rows within the dates are read
+    df_cell = read_table(cell_file, "cell", date_ranges=[(start_date, end_date)])
+    df_trajectory = read_table(trajectory_file, "trajectory", date_ranges=[(start_date, end_date)])
+    raster = df_trajectory['owner'].nunique() > raster_above
+
+    fig, axes = plt.subplots(1, 3, figsize=(18, 6))
+    # the road layer is read once, every panel draws it as a single collection
+    walkway_df = read_roads(region_snapshot, bounding_box)
+    roads = [np.asarray(line.coords)[:, :2] for line in walkway_df.geometry.explode(index_parts=False) if not line.is_empty]
+    for ax in axes:
+        ax.add_collection(LineCollection(roads, colors='black', linewidths=0.5))
+        ax.set_xlim(bounding_box[0], bounding_box[2])
+        ax.set_ylim(bounding_box[1], bounding_box[3])
+
+    phone1 = df_cell['device'].astype(str).str.endswith("_1")
+    draw(axes[0], df_trajectory, 'owner', 'Trajectory', raster, bins, bounding_box)
+    draw(axes[1], df_cell.loc[phone1], 'device', 'Cell Towers: Phone 1', raster, bins, bounding_box)
+    draw(axes[2], df_cell.loc[~phone1], 'device', 'Cell Towers: Phone 2', raster, bins, bounding_box)
+
+    if output is not None:
+        fig.savefig(output, dpi=200, bbox_inches="tight")
+    else:
+        plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot trajectories and cell tower connections.")
+    parser.add_argument("--trajectory", default=OUTPUT_TRAJECTORY_FILE, help="trajectory csv file or store")
+    parser.add_argument("--cell", default=OUTPUT_CELL_FILE, help="cell csv file or store")
+    parser.add_argument("--start", default=start_date)
+    parser.add_argument("--end", default=end_date)
+    parser.add_argument("--region-snapshot", default=None, help="region snapshot to take the roads from")
+    parser.add_argument("--raster-above", type=int, default=raster_above,
+                        help="number of agents above which point density is plotted")
+    parser.add_argument("--bins", type=int, default=400, help="histogram bins per axis of the density")
+    parser.add_argument("--output", default=None, help="image file to write instead of showing the plot")
+    args = parser.parse_args()
+
+    main(args.trajectory, args.cell, args.start, args.end, args.region_snapshot, args.raster_above, args.bins, args.output)
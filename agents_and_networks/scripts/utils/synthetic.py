@@ -0,0 +1,125 @@
+import math
+import pickle
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from shapely.geometry import LineString, box
+
+
+"""
+Synthetic regions for benchmarking: a grid road network with building footprints in every block and a
+set of antennas, written in the same formats as the Geofabrik downloads and the antenna file.
+"""
+
+# South-west corner of the synthetic region (in Delft) and the block size in degrees
+ORIGIN = (4.3480, 52.0036)
+BLOCK_SIZE = (0.0020, 0.0012)
+
+
+class SyntheticGrid:
+    def __init__(self, x: float, y: float, scale: float) -> None:
+        self.x = x
+        self.y = y
+        self.scale = scale
+
+    def get_value_for_coord(self, point) -> float:
+        return math.exp(-math.hypot(point.x - self.x, point.y - self.y) / self.scale)
+
+
+class SyntheticCoverageModel:
+    """Stands in for a pickled coverage model, coverage decays exponentially with distance."""
+
+    def __init__(self, scale: float = 1000) -> None:
+        self.scale = scale
+
+    def probabilities(self, measurement) -> SyntheticGrid:
+        rd = measurement.coords.convert_to_rd()
+        return SyntheticGrid(rd.x, rd.y, self.scale)
+
+
+def get_bounding_box(blocks: int) -> tuple:
+    return (
+        ORIGIN[0],
+        ORIGIN[1],
+        ORIGIN[0] + blocks * BLOCK_SIZE[0],
+        ORIGIN[1] + blocks * BLOCK_SIZE[1],
+    )
+
+
+def write_region(
+    directory: str,
+    blocks: int,
+    buildings_per_block: int = 4,
+    num_antennas: int = 50,
+    seed: int = 0,
+) -> dict:
+    """
+    Write a synthetic region of blocks x blocks grid cells to directory and return the file
+    locations and bounding box, keyed like the model and sampler parameters.
+    """
+    rng = np.random.default_rng(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    bounding_box = get_bounding_box(blocks)
+
+    # roads on the block edges
+    xs = ORIGIN[0] + BLOCK_SIZE[0] * np.arange(blocks + 1)
+    ys = ORIGIN[1] + BLOCK_SIZE[1] * np.arange(blocks + 1)
+    # with a vertex at every crossing, so the road graph is connected
+    roads = [LineString([(x, y) for y in ys]) for x in xs] + [
+        LineString([(x, y) for x in xs]) for y in ys
+    ]
+    gpd.GeoDataFrame(
+        {"osm_id": np.arange(len(roads)), "fclass": "residential"},
+        geometry=roads,
+        crs="epsg:4326",
+    ).to_file(directory / "roads.gpkg")
+
+    # small footprints inside every block, away from the roads
+    corners = np.stack(np.meshgrid(xs[:-1], ys[:-1]), axis=-1).reshape(-1, 2)
+    corners = np.repeat(corners, buildings_per_block, axis=0)
+    offsets = rng.uniform(0.1, 0.8, size=corners.shape) * BLOCK_SIZE
+    footprints = [
+        box(x, y, x + 0.1 * BLOCK_SIZE[0], y + 0.1 * BLOCK_SIZE[1])
+        for x, y in corners + offsets
+    ]
+    gpd.GeoDataFrame(
+        {"osm_id": np.arange(len(footprints)), "type": "house"},
+        geometry=footprints,
+        crs="epsg:4326",
+    ).to_file(directory / "buildings.gpkg")
+
+    # antennas in rijksdriehoek coordinates, in the layout of the antenna file
+    lon = rng.uniform(bounding_box[0], bounding_box[2], num_antennas)
+    lat = rng.uniform(bounding_box[1], bounding_box[3], num_antennas)
+    x, y = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True).transform(lon, lat)
+    pd.DataFrame(
+        {
+            "id": np.arange(num_antennas),
+            "ID": np.arange(num_antennas),
+            "X": x,
+            "Y": y,
+            "HOOFDSOORT": "LTE",
+            "Hoofdstraalrichting": [f"{azimuth} graden" for azimuth in rng.integers(0, 360, num_antennas)],
+            "Samenvatting": "",
+            "Vermogen": 0,
+            "Frequentie": 800,
+            "Veilige afstand": 0,
+            "POSTCODE": "2611AA",
+            "WOONPLAATSNAAM": "Delft",
+        }
+    ).to_csv(directory / "antennas.csv", index=False)
+
+    with open(directory / "coverage_model", "wb") as coverage_file:
+        pickle.dump({("16", (0, 0)): SyntheticCoverageModel()}, coverage_file)
+
+    return {
+        "bounding_box": bounding_box,
+        "buildings_file": str(directory / "buildings.gpkg"),
+        "walkway_file": str(directory / "roads.gpkg"),
+        "cell_file": str(directory / "antennas.csv"),
+        "coverage_file": str(directory / "coverage_model"),
+    }
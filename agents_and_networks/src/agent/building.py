@@ -1,35 +1,60 @@
 from __future__ import annotations
 
-import uuid
+from typing import TYPE_CHECKING
 
 import mesa
 import mesa_geo as mg
+import numpy as np
 import pyproj
+from mesa_geo.geo_base import GeoBase
 from shapely.geometry import Polygon
 
+if TYPE_CHECKING:
+    from src.space.region import BuildingFootprints
+
 
 class Building(mg.GeoAgent):
     unique_id: int  # an ID that represents the building
     model: mesa.Model
-    geometry: Polygon
     crs: pyproj.CRS
     centroid: mesa.space.FloatCoordinate
-    name: str
     visited: bool
     function: float  # 1.0 for work, 2.0 for home, 0.0 for neither
     entrance_pos: mesa.space.FloatCoordinate  # nearest vertex on road
+    index: int  # position in Netherlands.buildings
+    _footprints: BuildingFootprints
+    _footprint_index: int
     
 
-    def __init__(self, unique_id, model, geometry, crs) -> None:
-        super().__init__(unique_id=unique_id, model=model, geometry=geometry, crs=crs)
+    def __init__(
+        self, unique_id, model, crs, centroid, footprints: BuildingFootprints, footprint_index: int
+    ) -> None:
+        # as GeoAgent, but the footprint is read from the shared footprints when it is needed
+        mesa.Agent.__init__(self, unique_id, model)
+        GeoBase.__init__(self, crs=crs)
+        self.centroid = centroid
+        self._footprints = footprints
+        self._footprint_index = footprint_index
         self.entrance = None
-        self.name = str(uuid.uuid4())
         self.function = 0
         self.visited = False
 
+    @property
+    def geometry(self) -> Polygon:
+        return self._footprints[self._footprint_index]
+
+    def keep_own_footprint(self) -> None:
+        """Hold only this building's footprint, so the shared footprints can be freed."""
+        from src.space.region import BuildingFootprints
+
+        geometries = np.empty(1, dtype=object)
+        geometries[0] = self.geometry
+        self._footprints = BuildingFootprints(geometries=geometries)
+        self._footprint_index = 0
+
     def __repr__(self) -> str:
         return (
-            f"{self.__class__.__name__}(unique_id={self.unique_id}, name={self.name}, "
+            f"{self.__class__.__name__}(unique_id={self.unique_id}, "
             f"function={self.function}, centroid={self.centroid})"
         )
 
@@ -4,9 +4,11 @@ import math
 import random
 import mesa
 import mesa_geo as mg
+import numpy as np
 import pyproj
 from shapely.geometry import LineString, Point
 from src.agent.building import Building
+from src.metrics import METRICS, timed
 from src.space.utils import UnitTransformer, redistribute_vertices, power_law_exponential_cutoff
 
 
@@ -21,6 +23,8 @@ class Commuter(mg.GeoAgent):
         mesa.space.FloatCoordinate
     ]  # a set containing nodes to visit in the shortest path
     step_in_path: int  # the number of step taking in the walk
+    trip_start: int  # model clock (in seconds) at which the first path vertex is reached
+    index: int  # position of the commuter in the trajectory output
     my_home: Building # agents home location
     my_work: Building # agents work location (only used for certain experiments)
     next_location: Building
@@ -28,9 +32,10 @@ class Commuter(mg.GeoAgent):
         Building
     ]
     frequencies: list[int]
-    wait_time_h: int  # time to start going to work, hour and minute
-    wait_time_m: int
+    visited_set: np.ndarray | set  # of the visited locations, as made by the space's new_visited_set
+    departure_time: int  # model clock (in seconds) at which to start the next trip
     status: str  # work, home, or transport
+    RESOLUTION: int  # seconds between consecutive path vertices
     SPEED_WALK: float
     ALPHA: float # jump
     TAU_jump: float # max jump
@@ -49,6 +54,7 @@ class Commuter(mg.GeoAgent):
         self.my_home = None
         self.visited_locations = []
         self.frequencies = []
+        self.visited_set = model.space.new_visited_set()
         self._set_wait_time()
         
 
@@ -57,19 +63,13 @@ class Commuter(mg.GeoAgent):
             f"Commuter(unique_id={self.unique_id}, geometry={self.geometry}, "
         )
 
-    def _set_wait_time(self) -> None:
-        # Total time passed in minutes
-        time_passed_m = (self.model.hour * 60) + self.model.minute
-        # Get waiting time 
-        wait_time_m = (power_law_exponential_cutoff(self.TAU_time_min, self.TAU_time, self.BETA, self.TAU_time))*60
-        # Set correct new time
-        total_time_m = wait_time_m + time_passed_m
-        self.wait_time_h = math.floor(total_time_m/60)
-        self.wait_time_m = int((total_time_m-self.wait_time_h*60))
-         
-        # Hour resets ever 24 hours
-        if (self.wait_time_h >= 24):
-            self.wait_time_h = self.wait_time_h % 24
+    def _set_wait_time(self, arrival_time: int | None = None) -> None:
+        # Get waiting time in seconds
+        wait_time_s = (power_law_exponential_cutoff(self.TAU_time_min, self.TAU_time, self.BETA, self.TAU_time))*3600
+        # Set absolute departure time
+        if arrival_time is None:
+            arrival_time = self.model.clock
+        self.departure_time = arrival_time + math.floor(wait_time_s)
 
 
     def set_home(self, new_home: Building) -> None:
@@ -84,16 +84,63 @@ class Commuter(mg.GeoAgent):
     def set_visited_location(self, location: Building, frequency: int) -> None:
         self.visited_locations.append(location)
         self.frequencies.append(frequency)
+        self.model.space.mark_visited(self.visited_set, location)
+
+    def get_state(self) -> dict:
+        """Return the state needed to resume this commuter, buildings by unique_id."""
+        in_transport = self.status == "transport"
+        return {
+            "unique_id": self.unique_id,
+            "index": self.index,
+            "position": (self.geometry.x, self.geometry.y),
+            "status": self.status,
+            "home": self.my_home.unique_id,
+            "next_location": self.next_location.unique_id,
+            "visited_locations": [location.unique_id for location in self.visited_locations],
+            "frequencies": list(self.frequencies),
+            "departure_time": self.departure_time,
+            "origin": self.origin.unique_id if in_transport else None,
+            "destination": self.destination.unique_id if in_transport else None,
+            "path": self.my_path if in_transport else None,
+            "step_in_path": self.step_in_path if in_transport else None,
+            "trip_start": self.trip_start if in_transport else None,
+        }
+
+    def set_state(self, state: dict) -> None:
+        space = self.model.space
+        self.index = state["index"]
+        self.status = state["status"]
+        self.set_home(space.get_building_by_id(state["home"]))
+        self.set_next_location(space.get_building_by_id(state["next_location"]))
+        for unique_id, frequency in zip(state["visited_locations"], state["frequencies"]):
+            location = space.get_building_by_id(unique_id)
+            location.visited = True
+            self.set_visited_location(location, frequency)
+        self.departure_time = state["departure_time"]
+        if self.status == "transport":
+            self.origin = space.get_building_by_id(state["origin"])
+            self.destination = space.get_building_by_id(state["destination"])
+            self.my_path = state["path"]
+            self.step_in_path = state["step_in_path"]
+            self.trip_start = state["trip_start"]
 
     def step(self) -> None: 
         self._prepare_to_move()
         self._move()
+        # with coarse adaptive ticks, a commuter can arrive and leave again within one tick
+        while (
+            self.model.adaptive
+            and self.status != "transport"
+            and self.model.clock >= self.departure_time
+        ):
+            self._prepare_to_move()
+            self._move()
         
 
     def _prepare_to_move(self) -> None:
         if (
             (self.status == "home" or self.status == "work" or self.status == "other")
-            and (self.model.hour == self.wait_time_h and self.model.minute >= self.wait_time_m)
+            and self.model.clock >= self.departure_time
         ): 
             self.origin = self.next_location
             p = self.RHO*(math.pow(len(self.visited_locations),(-1*self.GAMMA)))
@@ -108,41 +155,48 @@ class Commuter(mg.GeoAgent):
             )
 
             self._path_select()
+            # adaptive ticks start the trip at its exact departure time, otherwise at this tick
+            self.trip_start = self.departure_time if self.model.adaptive else self.model.clock
             self.status = "transport"
                      
 
     def _move(self) -> None:
         if self.status == "transport":
-            if self.step_in_path < len(self.my_path):
-                next_position = self.my_path[self.step_in_path]
-                self.model.space.move_commuter(self, next_position, False)
-                self.step_in_path += 1
-            else:
+            # vertex k is reached at trip_start + k * RESOLUTION, every vertex
+            # passed since the last tick is recorded with its exact time
+            now = self.model.clock
+            reached = min((now - self.trip_start) // self.RESOLUTION + 1, len(self.my_path))
+            if reached > self.step_in_path:
+                for k in range(self.step_in_path, reached):
+                    self.model.record_position(
+                        self, self.my_path[k], self.trip_start + k * self.RESOLUTION, self.status
+                    )
+                self.model.space.move_commuter(self, self.my_path[reached - 1], False)
+                self.step_in_path = reached
+            arrival_time = self.trip_start + len(self.my_path) * self.RESOLUTION
+            if self.step_in_path == len(self.my_path) and now >= arrival_time:
                 self.model.space.move_commuter(self, self.destination.centroid,True)
-                self._set_wait_time()
+                self._set_wait_time(arrival_time)
                 if self.destination == self.my_home:
                     self.status = "home"
                 else:
                     self.status = "other"
+                self.model.record_position(self, self.destination.centroid, arrival_time, self.status)
                 
 
 
     def _explore(self) -> None:
-        visited_locations = self.visited_locations 
-        frequencies = self.frequencies
-
         jump_length = (power_law_exponential_cutoff(self.TAU_jump_min, self.TAU_jump, self.ALPHA, self.TAU_jump)*100)
         theta = random.uniform(0, 2*math.pi)
         new_point = Point(self.geometry.x + jump_length * math.cos(theta),
         self.geometry.y + jump_length * math.sin(theta))      
-        min_location = self.model.space.get_nearest_building(new_point, visited_locations)
+        min_location = self.model.space.get_nearest_building(new_point, self.visited_set)
 
         # Set new location as building closest to this point
         min_location.visited = True
         self.set_next_location(min_location)
 
-        visited_locations.append(min_location)
-        frequencies.append(1)
+        self.set_visited_location(min_location, 1)
 
     def _return(self) -> None:
         visited_locations = self.visited_locations 
@@ -157,6 +211,7 @@ class Commuter(mg.GeoAgent):
         self.set_next_location(new_location[0])
 
 
+    @timed("path_select")
     def _path_select(self) -> None:
         self.step_in_path = 0
         if (
@@ -164,8 +219,10 @@ class Commuter(mg.GeoAgent):
                 source=self.origin.entrance_pos, target=self.destination.entrance_pos
             )
         ) is not None:
+            METRICS.count("path_cache_hit")
             self.my_path = cached_path
         else:
+            METRICS.count("path_cache_miss")
             self.my_path = self.model.walkway.get_shortest_path(
                 source=self.origin.entrance_pos, target=self.destination.entrance_pos
             )
@@ -178,6 +235,7 @@ class Commuter(mg.GeoAgent):
         self._redistribute_path_vertices()
 
 
+    @timed("redistribute_path_vertices")
     def _redistribute_path_vertices(self) -> None:
         # if origin and destination share the same entrance, then self.my_path
         # will contain only this entrance node,
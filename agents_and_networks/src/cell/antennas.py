@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+class AntennaIndex:
+    """
+    Spatial index over antenna positions and main beam directions, used to
+    find the closest antenna whose sector faces a position.
+
+    Positions and antennas are given in the same planar (x, y) coordinates.
+    An antenna faces a position when the angle from the antenna to the
+    position lies within ``sector_width`` degrees of its azimuth.
+    """
+
+    INITIAL_K: int = 8
+    _kd_tree: KDTree
+    _coords: np.ndarray
+    _azimuths: np.ndarray
+    _sector_width: float
+    _max_cached: int
+    _cache: OrderedDict[tuple[float, float], int]
+
+    def __init__(
+        self,
+        coords: np.ndarray,
+        azimuths: np.ndarray,
+        sector_width: float = 60.0,
+        max_cached: int = 100000,
+    ) -> None:
+        self._coords = np.asarray(coords, dtype=float)
+        self._azimuths = np.asarray(azimuths, dtype=float)
+        self._sector_width = sector_width
+        self._kd_tree = KDTree(self._coords)
+        self._max_cached = max_cached
+        self._cache = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._coords)
+
+    def query(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Return for every position the index of the nearest antenna facing it.
+        If no antenna faces a position, the nearest antenna is returned.
+        Results are memoized per distinct position, for the max_cached most
+        recently queried positions.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        unique, inverse = np.unique(positions, axis=0, return_inverse=True)
+        result = np.empty(len(unique), dtype=int)
+        missing = []
+        for i, position in enumerate(map(tuple, unique)):
+            if (cached := self._cache.get(position)) is not None:
+                result[i] = cached
+                self._cache.move_to_end(position)
+            else:
+                missing.append(i)
+        if missing:
+            found = self._query_facing(unique[missing])
+            result[missing] = found
+            self._cache.update(zip(map(tuple, unique[missing]), found.tolist()))
+            while len(self._cache) > self._max_cached:
+                self._cache.popitem(last=False)
+        return result[inverse.reshape(-1)]
+
+    def _query_facing(self, positions: np.ndarray) -> np.ndarray:
+        num_antennas = len(self._coords)
+        result = np.empty(len(positions), dtype=int)
+        pending = np.arange(len(positions))
+        k = min(self.INITIAL_K, num_antennas)
+        while len(pending) > 0:
+            indices = self._kd_tree.query(positions[pending], k=k, return_distance=False)
+            facing = self._facing(positions[pending], indices)
+            found = facing.any(axis=1)
+            first = facing.argmax(axis=1)
+            result[pending[found]] = indices[found, first[found]]
+            if k == num_antennas:
+                # no antenna faces these positions, fall back to the nearest one
+                result[pending[~found]] = indices[~found, 0]
+                break
+            pending = pending[~found]
+            k = min(k * 4, num_antennas)
+        return result
+
+    def _facing(self, positions: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        antennas = self._coords[indices]
+        delta = positions[:, None, :] - antennas
+        angles = (np.degrees(np.arctan2(delta[..., 1], delta[..., 0])) + 360) % 360
+        azimuths = self._azimuths[indices]
+        return (angles >= azimuths - self._sector_width) & (
+            angles <= azimuths + self._sector_width
+        )
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+
+# the columns the samplers do not use, antennas that only differ in them are duplicates
+IGNORED_COLUMNS = ["Samenvatting", "Vermogen", "Frequentie", "Veilige afstand", "id"]
+
+# part of the cache key, raise when the arrays of the registry change
+REGISTRY_VERSION = 2
+
+_rd_to_wgs84 = Transformer.from_crs("EPSG:28992", "EPSG:4326", always_xy=True)
+
+
+@dataclass(frozen=True)
+class AntennaRegistry:
+    """
+    The antennas of a cell file within a bounding box, parsed, deduplicated
+    and projected once. Row i of every array describes the same antenna.
+
+    Directions keep the main beam direction as written in the cell file.
+    Labels are its digits, as the samplers report it, and azimuths their
+    value in degrees, NaN for antennas without a main beam direction.
+    """
+
+    ids: np.ndarray
+    rd: np.ndarray
+    wgs84: np.ndarray
+    directions: np.ndarray
+    azimuths: np.ndarray
+    labels: np.ndarray
+    technology: pd.Categorical
+    zipcodes: np.ndarray
+    cities: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def latlon(self) -> np.ndarray:
+        """The WGS84 coordinates as (lat, lon), wgs84 holds them as (lon, lat)."""
+        return self.wgs84[:, ::-1]
+
+    def select(self, mask: np.ndarray) -> AntennaRegistry:
+        """Return the registry of the antennas in the mask."""
+        mask = np.asarray(mask)
+        return AntennaRegistry(
+            ids=self.ids[mask],
+            rd=self.rd[mask],
+            wgs84=self.wgs84[mask],
+            directions=self.directions[mask],
+            azimuths=self.azimuths[mask],
+            labels=self.labels[mask],
+            technology=self.technology[mask],
+            zipcodes=self.zipcodes[mask],
+            cities=self.cities[mask],
+        )
+
+    def with_technology(self, technology: str) -> AntennaRegistry:
+        return self.select(np.asarray(self.technology == technology))
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path,
+            ids=self.ids,
+            rd=self.rd,
+            wgs84=self.wgs84,
+            directions=self.directions,
+            azimuths=self.azimuths,
+            labels=self.labels,
+            technology_codes=self.technology.codes,
+            technology_categories=np.asarray(self.technology.categories, dtype=str),
+            zipcodes=self.zipcodes,
+            cities=self.cities,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> AntennaRegistry:
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"],
+                rd=arrays["rd"],
+                wgs84=arrays["wgs84"],
+                directions=arrays["directions"],
+                azimuths=arrays["azimuths"],
+                labels=arrays["labels"],
+                technology=pd.Categorical.from_codes(
+                    arrays["technology_codes"], arrays["technology_categories"]
+                ),
+                zipcodes=arrays["zipcodes"],
+                cities=arrays["cities"],
+            )
+
+
+def parse_antennas(
+    cell_file: str, bounding_box: tuple[float, float, float, float], increase: float = 0.0
+) -> AntennaRegistry:
+    """
+    Read the antennas of a cell file, drop the duplicates, project them to
+    WGS84 and keep those within the bounding box (lon/lat, expanded by
+    increase degrees on every side).
+    """
+    df = pd.read_csv(cell_file)
+    df = df.drop(columns=IGNORED_COLUMNS, errors="ignore").drop_duplicates()
+    x = df["X"].to_numpy(dtype=float)
+    y = df["Y"].to_numpy(dtype=float)
+    lon, lat = _rd_to_wgs84.transform(x, y)
+    inside = (
+        (lon >= bounding_box[0] - increase)
+        & (lon <= bounding_box[2] + increase)
+        & (lat >= bounding_box[1] - increase)
+        & (lat <= bounding_box[3] + increase)
+    )
+    df = df.loc[inside]
+    directions = df["Hoofdstraalrichting"].fillna("").astype(str)
+    labels = directions.str.replace(r"\D", "", regex=True)
+    return AntennaRegistry(
+        ids=df["ID"].astype(str).to_numpy(dtype=str),
+        rd=np.column_stack([x[inside], y[inside]]),
+        wgs84=np.column_stack([lon[inside], lat[inside]]),
+        directions=directions.to_numpy(dtype=str),
+        azimuths=pd.to_numeric(labels, errors="coerce").to_numpy(dtype=float),
+        labels=labels.to_numpy(dtype=str),
+        technology=pd.Categorical(df["HOOFDSOORT"].astype(str)),
+        zipcodes=df["POSTCODE"].fillna("").astype(str).to_numpy(dtype=str),
+        cities=df["WOONPLAATSNAAM"].fillna("").astype(str).to_numpy(dtype=str),
+    )
+
+
+def get_file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_antennas(
+    cell_file: str,
+    bounding_box: tuple[float, float, float, float],
+    increase: float = 0.0,
+    cache_dir: str | None = "outputs",
+) -> AntennaRegistry:
+    """
+    Return the antenna registry of a cell file within the bounding box. The
+    registry is cached in cache_dir under the digest of the cell file and
+    the bounding box, so an edited cell file or another region is parsed
+    again. Pass cache_dir=None to always parse.
+    """
+    if cache_dir is None:
+        return parse_antennas(cell_file, bounding_box, increase)
+    key = hashlib.sha256(
+        f"{REGISTRY_VERSION}:{get_file_digest(cell_file)}:{tuple(map(float, bounding_box))}:{float(increase)}".encode()
+    ).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"antennas_{key}.npz")
+    if os.path.exists(path):
+        return AntennaRegistry.load(path)
+    registry = parse_antennas(cell_file, bounding_box, increase)
+    os.makedirs(cache_dir, exist_ok=True)
+    registry.save(path)
+    return registry
@@ -0,0 +1,461 @@
+from __future__ import annotations
+
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src.cell.antennas import AntennaIndex
+from src.store import read_table
+from telcell.data.models import PointArray, RDPoint
+
+EVENT_COLUMNS = ["owner", "phone", "seconds", "lon", "lat"]
+
+
+def get_trajectory_seconds(df: pd.DataFrame, start: datetime) -> pd.Series:
+    """
+    Return the seconds passed since start for every trajectory row. Files
+    written with a seconds column only need a single timestamp parsed to
+    align it with start, legacy files are parsed in one vectorized call.
+    """
+    if "seconds" in df:
+        if len(df) == 0:
+            return df["seconds"].astype("int64")
+        first = pd.Timestamp(df["timestamp"].iloc[0])
+        offset = (first - start) // pd.Timedelta(seconds=1) - df["seconds"].iloc[0]
+        return df["seconds"].astype("int64") + offset
+    timestamps = pd.to_datetime(df["timestamp"], format="ISO8601")
+    return (timestamps - start) // pd.Timedelta(seconds=1)
+
+
+def read_trajectory(path: str, start_date: str, end_date: str) -> pd.DataFrame:
+    """
+    Read a trajectory file limited to the start and end date, with columns
+    owner, seconds (passed since the start date), lon, lat and status.
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    # rows up to the end date, the exact window is taken on the seconds below
+    df = read_table(path, "trajectory", date_ranges=[(start_date, end_date)])
+    df = df.rename(columns={"cellinfo.wgs84.lon": "lon", "cellinfo.wgs84.lat": "lat"})
+    df["seconds"] = get_trajectory_seconds(df, start)
+    return df.loc[(df["seconds"] >= 0) & (df["seconds"] < (end - start).total_seconds())]
+
+
+def trajectory_from_rows(rows: list[list]) -> pd.DataFrame:
+    """
+    Build a trajectory frame from rows as passed on by the trajectory model,
+    which carry the integer clock in their last column.
+    """
+    return pd.DataFrame(
+        rows, columns=["id", "owner", "timestamp", "lon", "lat", "status", "seconds"]
+    )
+
+
+def get_positions_at(seconds: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    Return for every time the row index of the last trajectory position that
+    was reached strictly before that time.
+    """
+    return np.maximum(np.searchsorted(seconds, times, side="left") - 1, 0)
+
+
+class EventStream:
+    """
+    Samples phone usage events from trajectory rows. Event times follow a
+    Poisson process per phone, and every event takes the last position its
+    owner reached before it. Rows of an owner have to be fed in time order,
+    but may arrive in any number of batches, so trajectories can be
+    streamed in while they are generated.
+    """
+
+    num_phones: int
+    start_seconds: float  # no events are drawn before this time
+    _rng: np.random.Generator
+    _scale: float
+    _last: dict[str, tuple[float, float, float]]
+    _next_times: dict[str, list[float]]
+    _homes: dict[str, tuple[float, float]]
+
+    def __init__(
+        self,
+        num_phones: int = 2,
+        rng: np.random.Generator | None = None,
+        scale: float = 3600,
+    ) -> None:
+        self.num_phones = num_phones
+        self.start_seconds = 0.0
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._scale = scale
+        self._last = {}
+        self._next_times = {}
+        self._homes = {}
+
+    def start_at(
+        self,
+        seconds: float,
+        positions: dict[str, tuple[float, float]] | None = None,
+        homes: dict[str, tuple[float, float]] | None = None,
+    ) -> None:
+        """
+        Draw no events before seconds. With positions, the (lon, lat) every
+        owner was at by then, events before the next row of an owner take
+        that position, and homes replace the home rows written before.
+        """
+        self.start_seconds = seconds
+        for owner, position in (positions or {}).items():
+            self._last[owner] = (seconds, *position)
+        self._homes.update(homes or {})
+
+    def get_home(self, owner: str) -> tuple[float, float] | None:
+        """Return the (lon, lat) of the first row of the owner at home."""
+        return self._homes.get(owner)
+
+    def feed(self, trajectory: pd.DataFrame) -> pd.DataFrame:
+        """
+        Consume trajectory rows with columns owner, seconds, lon, lat and
+        status, and return the events that are fully determined by them,
+        ordered by owner, phone and time.
+        """
+        events = []
+        for owner, rows in trajectory.groupby("owner", sort=True):
+            seconds = rows["seconds"].to_numpy(dtype=float)
+            positions = rows[["lon", "lat"]].to_numpy(dtype=float)
+            if owner not in self._homes:
+                home = positions[(rows["status"] == "home").to_numpy()]
+                if len(home) > 0:
+                    self._homes[owner] = tuple(home[0])
+            if (last := self._last.get(owner)) is not None:
+                seconds = np.concatenate([[last[0]], seconds])
+                positions = np.vstack([last[1:], positions])
+            next_times = self._next_times.get(owner)
+            if next_times is None:
+                next_times = [self.start_seconds + self._draw() for _ in range(self.num_phones)]
+            for phone in range(self.num_phones):
+                times, next_times[phone] = self._draw_until(
+                    next_times[phone], seconds[-1]
+                )
+                index = get_positions_at(seconds, times)
+                events.append(
+                    pd.DataFrame(
+                        {
+                            "owner": owner,
+                            "phone": phone,
+                            "seconds": times,
+                            "lon": positions[index, 0],
+                            "lat": positions[index, 1],
+                        }
+                    )
+                )
+            self._next_times[owner] = next_times
+            self._last[owner] = (seconds[-1], *positions[-1])
+        if not events:
+            return pd.DataFrame(columns=EVENT_COLUMNS)
+        return pd.concat(events, ignore_index=True)
+
+    def _draw(self) -> float:
+        return self._rng.exponential(scale=self._scale)
+
+    def _draw_until(self, first: float, max_time: float) -> tuple[np.ndarray, float]:
+        # returns the event times up to max_time and the first time after it
+        if first > max_time:
+            return np.empty(0), first
+        chunk = int((max_time - first) / self._scale) + 16
+        times = first + np.concatenate(
+            [[0.0], np.cumsum(self._rng.exponential(scale=self._scale, size=chunk))]
+        )
+        while times[-1] <= max_time:
+            extra = times[-1] + np.cumsum(
+                self._rng.exponential(scale=self._scale, size=chunk)
+            )
+            times = np.concatenate([times, extra])
+        split = np.searchsorted(times, max_time, side="right")
+        return times[:split], times[split]
+
+
+class CoverageCache:
+    """
+    Memo from rounded RD cell to the normalized cumulative weights of the
+    antennas, shared by all phones. Weights are evaluated at the rounded
+    cell, so a cell always gets the same distribution, and the least
+    recently used cells are dropped beyond max_cells.
+    """
+
+    hits: int
+    misses: int
+    _grids: list
+    _cell_size: float
+    _max_cells: int
+    _cdfs: OrderedDict[tuple[float, float], np.ndarray]
+
+    def __init__(self, grids: list, cell_size: float = 100, max_cells: int = 100000) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._grids = grids
+        self._cell_size = cell_size
+        self._max_cells = max_cells
+        self._cdfs = OrderedDict()
+
+    def get_cdf(self, x: float, y: float) -> np.ndarray:
+        cell = (
+            round(x / self._cell_size) * self._cell_size,
+            round(y / self._cell_size) * self._cell_size,
+        )
+        cdf = self._cdfs.get(cell)
+        if cdf is not None:
+            self.hits += 1
+            self._cdfs.move_to_end(cell)
+            return cdf
+        self.misses += 1
+        rd = RDPoint(x=cell[0], y=cell[1])
+        cdf = np.cumsum([grid.get_value_for_coord(rd) for grid in self._grids], dtype=float)
+        if len(cdf) == 0 or not cdf[-1] > 0:
+            raise ValueError(f"No antenna covers the RD cell {cell}")
+        cdf /= cdf[-1]
+        self._cdfs[cell] = cdf
+        if len(self._cdfs) > self._max_cells:
+            self._cdfs.popitem(last=False)
+        return cdf
+
+    def sample(self, x: float, y: float, u: float) -> int:
+        """Return the antenna drawn with the uniform number u in [0, 1) at (x, y)."""
+        cdf = self.get_cdf(x, y)
+        return min(int(np.searchsorted(cdf, u, side="right")), len(cdf) - 1)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"coverage cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), {len(self._cdfs)} cells"
+
+
+def get_device(owner: str, phone: int) -> str:
+    return f"{re.sub('[^0-9]', '', owner)}_{phone + 1}"
+
+
+class SimpleSampler:
+    """
+    Connects every phone event to the closest antenna facing it. Antenna
+    coordinates are given as (lon, lat).
+    """
+
+    HEADER = [
+        "owner",
+        "device",
+        "timestamp",
+        "cellinfo.wgs84.lon",
+        "cellinfo.wgs84.lat",
+        "cellinfo.azimuth_degrees",
+        "cell",
+    ]
+    _start: datetime
+    _coords: np.ndarray
+    _labels: np.ndarray
+    _antenna_index: AntennaIndex
+    _stream: EventStream
+
+    def __init__(
+        self,
+        start: datetime,
+        coords: np.ndarray,
+        azimuths: np.ndarray,
+        labels: np.ndarray,
+        rng: np.random.Generator | None = None,
+    ) -> None:
+        self._start = start
+        self._coords = np.asarray(coords, dtype=float)
+        self._labels = np.asarray(labels)
+        self._antenna_index = AntennaIndex(self._coords, azimuths)
+        self._stream = EventStream(num_phones=2, rng=rng)
+
+    def start_at(
+        self,
+        seconds: float,
+        positions: dict[str, tuple[float, float]] | None = None,
+        homes: dict[str, tuple[float, float]] | None = None,
+    ) -> None:
+        """
+        Draw no events before seconds, e.g. when a run resumes at a checkpoint,
+        continuing from the (lon, lat) positions and homes of the owners then.
+        """
+        self._stream.start_at(seconds, positions, homes)
+
+    def sample(self, trajectory: pd.DataFrame) -> list[list]:
+        events = self._stream.feed(trajectory)
+        cells = self._antenna_index.query(events[["lon", "lat"]].to_numpy(dtype=float))
+        return [
+            [
+                owner,
+                get_device(owner, phone),
+                self._start + timedelta(seconds=seconds),
+                *self._coords[cell],
+                self._labels[cell],
+                "0-0-0",
+            ]
+            for owner, phone, seconds, cell in zip(
+                events["owner"], events["phone"], events["seconds"].tolist(), cells
+            )
+        ]
+
+
+class CoverageModel:
+    """
+    The antennas of one coverage model: their (lat, lon) coordinates,
+    azimuth labels, and the distribution over them per rounded RD cell.
+    """
+
+    coords: np.ndarray
+    labels: np.ndarray
+    cache: CoverageCache
+
+    def __init__(
+        self, coords: np.ndarray, grids: list, labels: np.ndarray, max_cached_cells: int = 100000
+    ) -> None:
+        self.coords = np.asarray(coords, dtype=float)
+        self.labels = np.asarray(labels)
+        self.cache = CoverageCache(grids, max_cells=max_cached_cells)
+
+
+class MultiCoverageSampler:
+    """
+    Draws the antenna of every phone event from several coverage models,
+    e.g. one per operator and technology, in a single pass. Event times,
+    positions, RD conversions and phone assignments are shared by all
+    models, every model draws its antenna independently. Rows are tagged
+    with the name of their model in the last column.
+
+    Sampling method 1 samples both phones independently, 2 switches phones
+    on the time of day and 3 on the distance from home.
+    """
+
+    HEADER = [
+        "owner",
+        "device",
+        "timestamp",
+        "cellinfo.wgs84.lat",
+        "cellinfo.wgs84.lon",
+        "cellinfo.azimuth_degrees",
+        "cell",
+        "model",
+    ]
+    models: dict[str, CoverageModel]
+    _start: datetime
+    _sampling_method: int
+    _rng: np.random.Generator
+    _stream: EventStream
+
+    def __init__(
+        self,
+        start: datetime,
+        models: dict[str, CoverageModel],
+        sampling_method: int = 1,
+        rng: np.random.Generator | None = None,
+    ) -> None:
+        self.models = models
+        self._start = start
+        self._sampling_method = sampling_method
+        self._rng = rng if rng is not None else np.random.default_rng()
+        # if we do independent sampling then we want to do full sampling twice
+        # for each phone, else we do the sampling once and switch phones
+        self._stream = EventStream(
+            num_phones=2 if sampling_method == 1 else 1, rng=self._rng
+        )
+
+    def start_at(
+        self,
+        seconds: float,
+        positions: dict[str, tuple[float, float]] | None = None,
+        homes: dict[str, tuple[float, float]] | None = None,
+    ) -> None:
+        """
+        Draw no events before seconds, e.g. when a run resumes at a checkpoint,
+        continuing from the (lon, lat) positions and homes of the owners then.
+        """
+        self._stream.start_at(seconds, positions, homes)
+
+    def sample(self, trajectory: pd.DataFrame) -> list[list]:
+        events = self._stream.feed(trajectory)
+        if len(events) == 0:
+            return []
+        rd_points = PointArray(lat=events["lat"], lon=events["lon"]).convert_to_rd()
+        x = rd_points.x.tolist()
+        y = rd_points.y.tolist()
+        owners = events["owner"].tolist()
+        seconds = events["seconds"].tolist()
+        devices = [
+            get_device(owner, phone)
+            for owner, phone in zip(owners, self._get_phones(events))
+        ]
+        timestamps = [self._start + timedelta(seconds=second) for second in seconds]
+        draws = self._rng.random((len(self.models), len(events)))
+        rows = []
+        for (name, model), model_draws in zip(self.models.items(), draws):
+            for owner, device, timestamp, point_x, point_y, u in zip(
+                owners, devices, timestamps, x, y, model_draws.tolist()
+            ):
+                index_cell = model.cache.sample(point_x, point_y, u)
+                rows.append(
+                    [
+                        owner,
+                        device,
+                        timestamp,
+                        *model.coords[index_cell],
+                        model.labels[index_cell],
+                        "0-0-0",
+                        name,
+                    ]
+                )
+        return rows
+
+    def _get_phones(self, events: pd.DataFrame) -> list[int]:
+        if self._sampling_method == 2:
+            day_time = events["seconds"].to_numpy() % 86400
+            return ((32400 <= day_time) & (day_time <= 61200)).astype(int).tolist()
+        if self._sampling_method == 3:
+            homes = np.array([self._stream.get_home(owner) for owner in events["owner"]])
+            distance = np.hypot(
+                events["lat"].to_numpy() - homes[:, 1], events["lon"].to_numpy() - homes[:, 0]
+            )
+            return (distance > 0.05).astype(int).tolist()
+        return events["phone"].tolist()
+
+    def summary(self) -> str:
+        return "\n".join(f"{name}: {model.cache.summary()}" for name, model in self.models.items())
+
+
+class CoverageSampler(MultiCoverageSampler):
+    """
+    Draws the antenna of every phone event from a coverage model, given the
+    coverage grid of every antenna. Antenna coordinates are given as
+    (lat, lon).
+    """
+
+    HEADER = MultiCoverageSampler.HEADER[:-1]
+
+    def __init__(
+        self,
+        start: datetime,
+        coords: np.ndarray,
+        grids: list,
+        labels: np.ndarray,
+        sampling_method: int = 1,
+        rng: np.random.Generator | None = None,
+        max_cached_cells: int = 100000,
+    ) -> None:
+        super().__init__(
+            start,
+            {"": CoverageModel(coords, grids, labels, max_cached_cells)},
+            sampling_method,
+            rng,
+        )
+
+    @property
+    def cache(self) -> CoverageCache:
+        return self.models[""].cache
+
+    def sample(self, trajectory: pd.DataFrame) -> list[list]:
+        return [row[:-1] for row in super().sample(trajectory)]
+
+    def summary(self) -> str:
+        return self.cache.summary()
@@ -0,0 +1,147 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import DefaultDict, Optional, TextIO
+
+
+class Metrics:
+    """
+    Opt-in counters and timers for the hot paths of the simulation. Metrics
+    are aggregated per interval (a simulated hour) and emitted either as one
+    JSON line per interval or as a Prometheus textfile that is replaced on
+    every emit. Nothing is measured until the metrics are enabled.
+    """
+
+    enabled: bool
+    _path: Optional[str]
+    _format: str
+    _output: Optional[TextIO]
+    _counts: DefaultDict[str, int]
+    _seconds: DefaultDict[str, float]
+    _total_counts: DefaultDict[str, int]
+    _total_seconds: DefaultDict[str, float]
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._path = None
+        self._format = "jsonl"
+        self._output = None
+        self._counts = defaultdict(int)
+        self._seconds = defaultdict(float)
+        self._total_counts = defaultdict(int)
+        self._total_seconds = defaultdict(float)
+
+    def enable(self, path: str, format: str = "jsonl") -> None:
+        if format not in ("jsonl", "prometheus"):
+            raise ValueError(f"Unknown metrics format: {format}")
+        self.close()
+        for values in (self._counts, self._seconds, self._total_counts, self._total_seconds):
+            values.clear()
+        self.enabled = True
+        self._path = path
+        self._format = format
+        if format == "jsonl":
+            self._output = open(path, "w")
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            self._counts[name] += n
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self._counts[name] += 1
+        self._seconds[name] += seconds
+
+    @contextmanager
+    def timer(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def emit(self, clock: int) -> None:
+        """Emit the metrics of the interval ending at the given model clock."""
+        if not self.enabled:
+            return
+        for name, n in self._counts.items():
+            self._total_counts[name] += n
+        for name, seconds in self._seconds.items():
+            self._total_seconds[name] += seconds
+        if self._format == "jsonl":
+            metrics = {
+                name: {"count": n, "seconds": self._seconds[name]}
+                if name in self._seconds
+                else {"count": n}
+                for name, n in sorted(self._counts.items())
+            }
+            self._output.write(json.dumps({"clock": clock, "metrics": metrics}) + "\n")
+            self._output.flush()
+        else:
+            self._write_prometheus(clock)
+        self._counts.clear()
+        self._seconds.clear()
+
+    def _write_prometheus(self, clock: int) -> None:
+        lines = [
+            "# TYPE epr_model_clock_seconds gauge",
+            f"epr_model_clock_seconds {clock}",
+            "# TYPE epr_calls_total counter",
+        ]
+        lines += [
+            f'epr_calls_total{{name="{name}"}} {n}'
+            for name, n in sorted(self._total_counts.items())
+        ]
+        lines.append("# TYPE epr_seconds_total counter")
+        lines += [
+            f'epr_seconds_total{{name="{name}"}} {seconds}'
+            for name, seconds in sorted(self._total_seconds.items())
+        ]
+        # replace the file atomically, so the collector never reads a partial file
+        with open(self._path + ".tmp", "w") as output:
+            output.write("\n".join(lines) + "\n")
+        os.replace(self._path + ".tmp", self._path)
+
+    def summary(self) -> str:
+        """Return a table of the totals over all emitted intervals."""
+        rows = [f"{'name':<32}{'count':>12}{'seconds':>12}{'ms/call':>10}"]
+        for name, n in sorted(
+            self._total_counts.items(),
+            key=lambda item: -self._total_seconds.get(item[0], 0.0),
+        ):
+            seconds = self._total_seconds.get(name, 0.0)
+            per_call = f"{1000 * seconds / n:>10.3f}" if name in self._total_seconds else f"{'':>10}"
+            rows.append(f"{name:<32}{n:>12}{seconds:>12.3f}{per_call}")
+        return "\n".join(rows)
+
+    def close(self) -> None:
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+
+METRICS = Metrics()
+
+
+def timed(name: str):
+    """Decorator that counts and times calls while the metrics are enabled."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.add_time(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
@@ -1,7 +1,11 @@
+import json
+import os
+import pickle
+import random
 import uuid
 import geopandas as gpd
 import mesa
-import mesa_geo as mg
+import numpy as np
 import pandas as pd
 import csv
 
@@ -9,10 +13,15 @@ from shapely.geometry import Point
 from pyproj import Transformer
 from functools import partial
 from datetime import datetime, timedelta
+from typing import Callable, Optional
 
 from src.agent.building import Building
 from src.agent.commuter import Commuter
+from src.metrics import METRICS
 from src.space.netherlands import Netherlands
+from src.space.region import BuildingFootprints, get_centroids, load_region_snapshot, save_region_snapshot
+from src.space.tiling import TiledNetherlands, TiledWalkway
+from src.store import OutputStore, is_store
 from src.space.road_network import NetherlandsWalkway
 
 
@@ -37,14 +46,16 @@ def get_average_visited_locations(model) -> list:
 
 class AgentsAndNetworks(mesa.Model):
     schedule: mesa.time.RandomActivation
-    output_file: csv
+    output_file: Optional[str]
+    trajectory_sink: Optional[Callable[[list], None]]
     start_date: str
     current_id: int
     space: Netherlands
-    walkway: NetherlandsWalkway
+    walkway: NetherlandsWalkway | TiledWalkway
     bounding_box:list
     num_commuters: int
     step_duration: int
+    adaptive: bool
     alpha: float
     tau_jump: float    # in meters
     tau_jump_min: float
@@ -53,11 +64,9 @@ class AgentsAndNetworks(mesa.Model):
     tau_time_min: float
     rho: float
     gamma: float
-    day: int
-    hour: int
-    minute: int
-    second: int
-    positions_to_write: list[int,float,float,datetime]
+    clock: int  # seconds passed since start_date
+    write_seconds: bool
+    positions_to_write: list[int,float,float,int,str]
     positions: list[float,float]
     writing_id_trajectory:int
     common_work: Building
@@ -84,20 +93,69 @@ class AgentsAndNetworks(mesa.Model):
         commuter_speed_walk,
         model_crs="epsg:3857",
         start_date="2023-05-01",
+        trajectory_sink=None,
+        write_seconds=False,
+        adaptive=False,
+        output_resolution=None,
+        metrics_file=None,
+        metrics_format="jsonl",
+        region_snapshot=None,
+        checkpoint_file=None,
+        checkpoint_interval=24,
+        resume_from=None,
+        warm_start_file=None,
+        precompute_paths=False,
+        tile_size=None,
+        tile_overlap=1000,
+        max_tiles=9,
+        footprint_distance=True,
     ) -> None:
         super().__init__()
+        # opt-in timing of the hot paths, emitted once per simulated hour
+        if metrics_file is not None:
+            METRICS.enable(metrics_file, metrics_format)
         self.schedule = mesa.time.RandomActivation(self)
         self.start_date = datetime.strptime(start_date,"%Y-%m-%d")
         self.data_crs = data_crs
-        self.space = Netherlands(crs=model_crs)
+        if tile_size is not None:
+            # read buildings and roads per tile of tile_size meters, on demand
+            if resume_from is not None or warm_start_file is not None or checkpoint_file is not None:
+                raise ValueError("tiled regions can not be checkpointed, resumed or warm started")
+            self.space = TiledNetherlands(
+                model=self,
+                crs=model_crs,
+                data_crs=data_crs,
+                bounding_box=bounding_box,
+                buildings_file=buildings_file,
+                walkway_file=walkway_file,
+                tile_size=tile_size,
+                tile_overlap=tile_overlap,
+                max_tiles=max_tiles,
+                footprint_distance=footprint_distance,
+            )
+        else:
+            # without footprint distances, building footprints are never loaded by the simulation
+            self.space = Netherlands(crs=model_crs, footprint_distance=footprint_distance)
         self.num_commuters = num_commuters
         self.space.number_commuters = num_commuters
         self.bounding_box = bounding_box
         self.step_duration = step_duration
+        # In adaptive mode trips are timed independently of the ticks, so the
+        # step duration can be coarse while path vertices stay output_resolution apart
+        self.adaptive = adaptive
+        resolution = output_resolution if adaptive and output_resolution else step_duration
         self.positions_to_write = []
         self.positions = []
         self.output_file = output_file
-        Commuter.SPEED_WALK = commuter_speed_walk * step_duration  # meters per tick 
+        # output files ending in .sqlite or .db are indexed stores, with the seconds column
+        self._store = OutputStore(output_file) if output_file is not None and is_store(output_file) else None
+        self.trajectory_sink = trajectory_sink
+        self.write_seconds = write_seconds
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval  # in simulated hours
+        self._to_wgs84 = Transformer.from_crs(model_crs, "EPSG:4326", always_xy=True)
+        Commuter.RESOLUTION = resolution
+        Commuter.SPEED_WALK = commuter_speed_walk * resolution  # meters per path vertex
         Commuter.ALPHA = alpha
         Commuter.TAU_jump = tau_jump
         Commuter.TAU_jump_min = tau_jump_min
@@ -107,21 +165,46 @@ class AgentsAndNetworks(mesa.Model):
         Commuter.RHO = rho
         Commuter.GAMMA = gamma
 
-        self._load_buildings_from_file(buildings_file, crs=model_crs)
-        print("read in buildings file")
-        self._load_road_vertices_from_file(walkway_file, crs=model_crs)
-        print("read in road file")
-        self._set_building_entrance()
+        if tile_size is not None:
+            self.walkway = TiledWalkway(self.space)
+        else:
+            if region_snapshot is not None and os.path.exists(region_snapshot):
+                # the building footprints stay in the snapshot until they are needed
+                buildings_df, walkway_df = load_region_snapshot(region_snapshot, footprints=False)
+                print("read in region snapshot")
+            else:
+                buildings_df = self._read_buildings_file(buildings_file, crs=model_crs)
+                print("read in buildings file")
+                walkway_df = self._read_road_file(walkway_file, crs=model_crs)
+                print("read in road file")
+                if region_snapshot is not None:
+                    save_region_snapshot(region_snapshot, buildings_df, walkway_df)
+            if region_snapshot is not None:
+                footprints = BuildingFootprints(path=region_snapshot)
+            else:
+                footprints = BuildingFootprints(geometries=buildings_df.geometry.to_numpy())
+            self._load_buildings(buildings_df, footprints)
+            self.walkway = NetherlandsWalkway(lines=walkway_df["geometry"])
+            self._set_building_entrance()
+            # all trips run between entrances, so for compact regions route them up front
+            if precompute_paths:
+                self.walkway.precompute_paths(
+                    [building.entrance_pos for building in self.space.buildings]
+                )
 
-        self.day = 0
-        self.hour = 0
-        self.minute = 0
-        self.second = 0
-        
-        self.writing_id_trajectory = 0
-        self._create_commuters() 
-        output_file_trajectory = open(self.output_file, 'w')
-        csv.writer(output_file_trajectory).writerow(['id','owner','timestamp','cellinfo.wgs84.lon','cellinfo.wgs84.lat','status'])    
+        if resume_from is not None:
+            self._restore_checkpoint(resume_from)
+        else:
+            self.clock = 0
+            self.writing_id_trajectory = 0
+            self._create_commuters(warm_start_file) 
+            # the trajectory file is optional when rows are streamed to a sink
+            header = ['id','owner','timestamp','cellinfo.wgs84.lon','cellinfo.wgs84.lat','status']
+            if self._store is not None:
+                self._store.create("trajectory", header + ['seconds'])
+            elif self.output_file is not None:
+                with open(self.output_file, 'w') as output_file_trajectory:
+                    csv.writer(output_file_trajectory).writerow(header + ['seconds'] if self.write_seconds else header)
 
         self.datacollector = mesa.DataCollector(
             model_reporters={
@@ -139,119 +222,255 @@ class AgentsAndNetworks(mesa.Model):
         self.datacollector.collect(self)
         
         
-    def _create_commuters(self) -> None:
-        date = self.start_date
+    def _create_commuters(self, warm_start_file: Optional[str] = None) -> None:
+        # visitation state of a burn-in run, commuters beyond it start fresh
+        visitations = []
+        if warm_start_file is not None:
+            with open(warm_start_file) as warm_start:
+                visitations = json.load(warm_start)
         for i in range(self.num_commuters):
-            random_home = self.space.get_random_building()
+            if i < len(visitations):
+                home = self.space.get_building_by_id(visitations[i]["home"])
+            else:
+                home = self.space.get_random_building()
             commuter = Commuter(
                 unique_id=uuid.uuid4().int,
                 model=self,
-                geometry=Point(random_home.centroid),
+                geometry=Point(home.centroid),
                 crs=self.space.crs,
             )
-            commuter.set_home(random_home)
+            commuter.set_home(home)
             commuter.set_next_location(commuter.my_home)
-            random_home.visited = True
-            commuter.set_visited_location(random_home,1)
+            if i < len(visitations):
+                for unique_id, frequency in zip(
+                    visitations[i]["visited_locations"], visitations[i]["frequencies"]
+                ):
+                    location = self.space.get_building_by_id(unique_id)
+                    location.visited = True
+                    commuter.set_visited_location(location, frequency)
+            else:
+                home.visited = True
+                commuter.set_visited_location(home,1)
             commuter.status = "home"
             self.space.add_commuter(commuter, True)
+            commuter.index = i
             self.schedule.add(commuter)
             self.positions.append([commuter.geometry.x,commuter.geometry.y])
-            self.positions_to_write.append([i,commuter.geometry.x,commuter.geometry.y,date,commuter.status])
+            self.positions_to_write.append([i,commuter.geometry.x,commuter.geometry.y,self.clock,commuter.status])
 
-    def _load_buildings_from_file(
+    def _read_buildings_file(
         self, buildings_file: str, crs: str
-    ) -> None:
+    ) -> gpd.GeoDataFrame:
         # read in buildings from normal bounding box
         buildings_df = gpd.read_file(buildings_file, bbox=(self.bounding_box))
         # sample buildings for speedup
         # buildings_df = buildings_df.sample(frac =  0.01)
-        print("number buildings: ",len(buildings_df))
-        buildings_type = [0]*len(buildings_df)
         buildings_df.index.name = "unique_id"
-        buildings_df = buildings_df.set_crs(self.data_crs, allow_override=True).to_crs(
+        return buildings_df.set_crs(self.data_crs, allow_override=True).to_crs(
             crs
         )
-        buildings_df["centroid"] = [
-            (x, y) for x, y in zip(buildings_df.centroid.x, buildings_df.centroid.y)
-        ]
-        building_creator = mg.AgentCreator(Building, model=self)
-        buildings = building_creator.from_GeoDataFrame(buildings_df)
-        self.space.add_buildings(buildings,buildings_type)
 
-    def _load_road_vertices_from_file(
+    def _load_buildings(self, buildings_df: pd.DataFrame, footprints: BuildingFootprints) -> None:
+        print("number buildings: ",len(buildings_df))
+        self.space.load_buildings(self, buildings_df.index.tolist(), get_centroids(buildings_df), footprints)
+
+    def _read_road_file(
         self, walkway_file: str, crs: str
-    ) -> None:
-        walkway_df = (
+    ) -> gpd.GeoDataFrame:
+        return (
             gpd.read_file(walkway_file, self.bounding_box)
             .set_crs(self.data_crs, allow_override=True)
             .to_crs(crs)
         )
-        self.walkway = NetherlandsWalkway(lines=walkway_df["geometry"])
 
 
     def _set_building_entrance(self) -> None:
-        for building in (
-            *self.space.buildings,
-        ):
-            building.entrance_pos = self.walkway.get_nearest_node(building.centroid)
+        entrances = self.walkway.get_nearest_nodes(
+            [building.centroid for building in self.space.buildings]
+        )
+        for building, entrance_pos in zip(self.space.buildings, entrances):
+            building.entrance_pos = entrance_pos
+
+    def save_visitation_state(self, path: str) -> None:
+        """
+        Save the home, visited buildings and visit frequencies of every
+        commuter, so later runs can start from this (burn-in) state with
+        warm_start_file instead of from a single visited location.
+        """
+        commuters = sorted(self.schedule.agents, key=lambda commuter: commuter.index)
+        visitations = [
+            {
+                "home": int(commuter.my_home.unique_id),
+                "visited_locations": [int(location.unique_id) for location in commuter.visited_locations],
+                "frequencies": [int(frequency) for frequency in commuter.frequencies],
+            }
+            for commuter in commuters
+        ]
+        with open(path, "w") as visitation_file:
+            json.dump(visitations, visitation_file)
+
+    def get_written_positions(self) -> tuple[dict, dict]:
+        """
+        Return the (lon, lat) of the last written position and of the home of
+        every commuter, by owner as in the trajectory rows.
+        """
+        commuters = sorted(self.schedule.agents, key=lambda commuter: commuter.index)
+        owners = [f"Agent{commuter.index}" for commuter in commuters]
+        lon, lat = self._to_wgs84.transform(
+            [self.positions[commuter.index][0] for commuter in commuters]
+            + [commuter.my_home.centroid[0] for commuter in commuters],
+            [self.positions[commuter.index][1] for commuter in commuters]
+            + [commuter.my_home.centroid[1] for commuter in commuters],
+        )
+        coords = list(zip(lon, lat))
+        return dict(zip(owners, coords[:len(owners)])), dict(zip(owners, coords[len(owners):]))
+
+    def save_checkpoint(self, path: str) -> None:
+        """
+        Save the state of the simulation: the clock, every commuter with its
+        visited locations and in-flight path, the random number generators and
+        the size of the trajectory file. Buildings and roads are not stored,
+        they are loaded again from the region files or snapshot on resume.
+        """
+        if self.positions_to_write:
+            self.flush()
+        commuters = sorted(self.schedule.agents, key=lambda commuter: commuter.index)
+        state = {
+            "num_buildings": len(self.space.buildings),
+            "clock": self.clock,
+            "steps": self.schedule.steps,
+            "time": self.schedule.time,
+            "writing_id_trajectory": self.writing_id_trajectory,
+            "output_offset": os.path.getsize(self.output_file) if self.output_file is not None and self._store is None else None,
+            "positions": self.positions,
+            "commuters": [commuter.get_state() for commuter in commuters],
+            "random": random.getstate(),
+            "numpy_random": np.random.get_state(),
+            "model_random": self.random.getstate(),
+        }
+        with open(path + ".tmp", "wb") as checkpoint:
+            pickle.dump(state, checkpoint)
+        os.replace(path + ".tmp", path)
+
+    def _restore_checkpoint(self, path: str) -> None:
+        with open(path, "rb") as checkpoint:
+            state = pickle.load(checkpoint)
+        if state["num_buildings"] != len(self.space.buildings):
+            raise ValueError(
+                f"Checkpoint {path} was made for a region with {state['num_buildings']} "
+                f"buildings, this region has {len(self.space.buildings)}."
+            )
+        self.clock = state["clock"]
+        self.schedule.steps = state["steps"]
+        self.schedule.time = state["time"]
+        self.writing_id_trajectory = state["writing_id_trajectory"]
+        self.positions = state["positions"]
+        for commuter_state in state["commuters"]:
+            commuter = Commuter(
+                unique_id=commuter_state["unique_id"],
+                model=self,
+                geometry=Point(commuter_state["position"]),
+                crs=self.space.crs,
+            )
+            commuter.set_state(commuter_state)
+            self.space.add_commuter(commuter, True)
+            self.schedule.add(commuter)
+        # drop rows written after the checkpoint, the run continues from there
+        if self._store is not None:
+            self._store.delete_from("trajectory", state["writing_id_trajectory"])
+        elif self.output_file is not None:
+            with open(self.output_file, "r+") as output_file:
+                output_file.truncate(state["output_offset"])
+        # creating commuters draws waiting times, restore the generators last
+        random.setstate(state["random"])
+        np.random.set_state(state["numpy_random"])
+        self.random.setstate(state["model_random"])
 
 
 
     def step(self) -> None:
         self.__update_clock()
-        self.schedule.step()
+        with METRICS.timer("agent_step"):
+            self.schedule.step()
 
-        total_seconds = self.day*24*60*60 + self.hour*60*60 + self.minute*60 + self.second
-        time = self.start_date + timedelta(seconds = total_seconds)
 
-        for i in range(self.num_commuters):
-            commuter = self.schedule.agents[i]
-            x = commuter.geometry.x
-            y = commuter.geometry.y
-            if (self.positions[i][0] != x or self.positions[i][1] != y):
-                self.positions_to_write.append([i,x,y,time,commuter.status])
-                self.positions[i][0] = x
-                self.positions[i][1] = y
+        # flush once per simulated hour, whatever the step duration
+        if self.clock // 3600 != (self.clock - self.step_duration) // 3600:
+            self.flush()
+            if self.checkpoint_file is not None and self.clock // 3600 % self.checkpoint_interval == 0:
+                self.save_checkpoint(self.checkpoint_file)
 
+    def record_position(
+        self, commuter: Commuter, pos: mesa.space.FloatCoordinate, time: int, status: str
+    ) -> None:
+        """Buffer the position a commuter reached at the given clock time, if it moved."""
+        position = self.positions[commuter.index]
+        if position[0] != pos[0] or position[1] != pos[1]:
+            self.positions_to_write.append([commuter.index, pos[0], pos[1], time, status])
+            position[0] = pos[0]
+            position[1] = pos[1]
 
-        if (self.minute == 0 & self.second==0):
+    def flush(self) -> None:
+        """Write the buffered positions to the trajectory file and sink."""
+        with METRICS.timer("flush"):
             self.__write_to_file()
-            self.positions_to_write = []
-                
+        self.positions_to_write = []
+        METRICS.emit(self.clock)
     
     def __write_to_file(self) -> None:
-        output_file = open(self.output_file, 'a')
-        output_writer = csv.writer(output_file)
-        for pos in self.positions_to_write:
-            lon,lat = Transformer.from_crs("EPSG:3857","EPSG:4326").transform(pos[1],pos[2])
-            output_writer.writerow([self.writing_id_trajectory, f"Agent{pos[0]}", 
-                                   pos[3],
-                                   lat,lon,pos[4]])
-            self.writing_id_trajectory += 1
-        output_file.close()
-        total_seconds = self.day*24*60*60 + self.hour*60*60 + self.minute*60 + self.second
-        time = self.start_date + timedelta(seconds = total_seconds)
-        print("time: ",time)
+        # commuters record positions in schedule order, write them in time order
+        self.positions_to_write.sort(key=lambda pos: (pos[3], pos[0]))
+        lon, lat = self._to_wgs84.transform(
+            [pos[1] for pos in self.positions_to_write],
+            [pos[2] for pos in self.positions_to_write],
+        )
+        # rows carry the integer clock, timestamps are only formatted once per tick
+        timestamps = {
+            clock: self.start_date + timedelta(seconds=clock)
+            for clock in {pos[3] for pos in self.positions_to_write}
+        }
+        rows = [
+            [self.writing_id_trajectory + i, f"Agent{pos[0]}", timestamps[pos[3]], x, y, pos[4], pos[3]]
+            for i, (pos, x, y) in enumerate(zip(self.positions_to_write, lon, lat))
+        ]
+        self.writing_id_trajectory += len(rows)
+        if self._store is not None:
+            self._store.write("trajectory", rows)
+        elif self.output_file is not None:
+            with open(self.output_file, 'a') as output_file:
+                output_writer = csv.writer(output_file)
+                if self.write_seconds:
+                    output_writer.writerows(rows)
+                else:
+                    output_writer.writerows(row[:-1] for row in rows)
+        if self.trajectory_sink is not None:
+            self.trajectory_sink(rows)
+        print("time: ",self.start_date + timedelta(seconds=self.clock))
         print("average locations: ",get_average_visited_locations(self))
         
 
 
+    def close(self) -> None:
+        """Close the trajectory store, if the model writes to one."""
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
     def __update_clock(self) -> None:
-        self.second += self.step_duration
-        if self.second >= 60:
-            while self.second/60 >= 1:
-                self.minute += 1
-                self.second -= 60
-            if self.minute >= 60:
-                while self.minute/60 >= 1:
-                    self.hour += 1
-                    self.minute -= 60
-                if self.hour >= 24:
-                    self.day += 1
-                    self.hour = 0
-        
-                
-        
-               
-                    
\ No newline at end of file
+        self.clock += self.step_duration
+
+    @property
+    def day(self) -> int:
+        return self.clock // 86400
+
+    @property
+    def hour(self) -> int:
+        return self.clock // 3600 % 24
+
+    @property
+    def minute(self) -> int:
+        return self.clock // 60 % 60
+
+    @property
+    def second(self) -> int:
+        return self.clock % 60
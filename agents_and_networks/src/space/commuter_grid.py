@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import math
+from typing import Dict, List, Set, Tuple
+
+import mesa
+import numpy as np
+
+from src.agent.commuter import Commuter
+
+
+class CommuterGrid:
+    """
+    Positions of the commuters hashed on a grid of square cells of cell_size
+    meters. Positions live in one array with a slot per commuter, and every
+    occupied cell holds the slots of its commuters. A cell is dropped as soon
+    as its last commuter leaves, so memory is bounded by the number of
+    commuters rather than by the number of positions ever visited.
+    """
+
+    cell_size: float
+    _positions: np.ndarray
+    _commuters: List[Commuter | None]
+    _slots: Dict[int, int]  # by commuter unique_id
+    _free_slots: List[int]
+    _cells: Dict[Tuple[int, int], List[int]]
+
+    def __init__(self, cell_size: float = 100.0) -> None:
+        self.cell_size = cell_size
+        self._positions = np.full((16, 2), np.nan)
+        self._commuters = []
+        self._slots = {}
+        self._free_slots = []
+        self._cells = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _get_cell(self, float_pos: mesa.space.FloatCoordinate) -> Tuple[int, int]:
+        return (
+            math.floor(float_pos[0] / self.cell_size),
+            math.floor(float_pos[1] / self.cell_size),
+        )
+
+    def add(self, commuter: Commuter, float_pos: mesa.space.FloatCoordinate) -> None:
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._commuters[slot] = commuter
+        else:
+            slot = len(self._commuters)
+            self._commuters.append(commuter)
+            if slot == len(self._positions):
+                self._positions = np.concatenate(
+                    [self._positions, np.full_like(self._positions, np.nan)]
+                )
+        self._slots[commuter.unique_id] = slot
+        self._positions[slot] = float_pos
+        self._cells.setdefault(self._get_cell(float_pos), []).append(slot)
+
+    def remove(self, commuter: Commuter) -> None:
+        slot = self._slots.pop(commuter.unique_id)
+        self._leave_cell(slot)
+        self._positions[slot] = np.nan
+        self._commuters[slot] = None
+        self._free_slots.append(slot)
+
+    def move(self, commuter: Commuter, float_pos: mesa.space.FloatCoordinate) -> None:
+        slot = self._slots[commuter.unique_id]
+        cell = self._get_cell(float_pos)
+        if cell != self._get_cell(self._positions[slot]):
+            self._leave_cell(slot)
+            self._cells.setdefault(cell, []).append(slot)
+        self._positions[slot] = float_pos
+
+    def _leave_cell(self, slot: int) -> None:
+        cell = self._get_cell(self._positions[slot])
+        slots = self._cells[cell]
+        slots.remove(slot)
+        if not slots:
+            del self._cells[cell]
+
+    def get_commuters_at(self, float_pos: mesa.space.FloatCoordinate) -> Set[Commuter]:
+        slots = self._cells.get(self._get_cell(float_pos), [])
+        return {
+            self._commuters[slot]
+            for slot in slots
+            if self._positions[slot, 0] == float_pos[0] and self._positions[slot, 1] == float_pos[1]
+        }
+
+    def get_commuters_within(
+        self, float_pos: mesa.space.FloatCoordinate, radius: float
+    ) -> List[Commuter]:
+        """Commuters within radius meters of float_pos, nearest first."""
+        slots = self._get_slots_within(float_pos, radius)
+        if len(slots) == 0:
+            return []
+        distances = np.hypot(
+            self._positions[slots, 0] - float_pos[0], self._positions[slots, 1] - float_pos[1]
+        )
+        inside = distances <= radius
+        slots, distances = slots[inside], distances[inside]
+        return [self._commuters[slot] for slot in slots[np.argsort(distances, kind="stable")]]
+
+    def _get_slots_within(self, float_pos: mesa.space.FloatCoordinate, radius: float) -> np.ndarray:
+        first_x, first_y = self._get_cell((float_pos[0] - radius, float_pos[1] - radius))
+        last_x, last_y = self._get_cell((float_pos[0] + radius, float_pos[1] + radius))
+        if (last_x - first_x + 1) * (last_y - first_y + 1) > len(self._cells):
+            # a radius spanning more cells than are occupied, look at all of them
+            cells = [
+                slots for (x, y), slots in self._cells.items()
+                if first_x <= x <= last_x and first_y <= y <= last_y
+            ]
+        else:
+            cells = [
+                self._cells[(x, y)]
+                for x in range(first_x, last_x + 1)
+                for y in range(first_y, last_y + 1)
+                if (x, y) in self._cells
+            ]
+        if not cells:
+            return np.empty(0, dtype=int)
+        return np.concatenate(cells).astype(int)
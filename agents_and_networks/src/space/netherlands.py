@@ -1,31 +1,46 @@
+import math
 import random
 from collections import defaultdict
-from typing import DefaultDict, Dict, Optional, Set, Tuple
+from typing import DefaultDict, Dict, List, Optional, Set, Tuple
 
 import mesa
 import mesa_geo as mg
+import numpy as np
+import shapely
 from shapely.geometry import Point
 
 from src.agent.building import Building
 from src.agent.commuter import Commuter
+from src.metrics import timed
+from src.space.commuter_grid import CommuterGrid
+from src.space.region import BuildingFootprints
 
 class Netherlands(mg.GeoSpace):
     buildings: Tuple[Building]
     home_counter: DefaultDict[mesa.space.FloatCoordinate, int]
     commuters: list[Commuter]
     number_commuters: int
+    footprint_distance: bool  # nearest buildings by footprint, else by centroid
     _buildings: Dict[int, Building]
-    _commuters_pos_map: DefaultDict[mesa.space.FloatCoordinate, Set[Commuter]]
+    _commuter_grid: CommuterGrid
     _commuter_id_map: Dict[int, Commuter]
-
-    def __init__(self, crs: str) -> None:
+    # buckets of building indices on a regular grid over the buildings' extent
+    _building_geometries: Optional[np.ndarray]
+    _grid_cells: Dict[Tuple[int, int], np.ndarray]
+    _grid_origin: Tuple[float, float]
+    _grid_shape: Tuple[int, int]
+    _grid_cell_size: float
+
+    def __init__(self, crs: str, footprint_distance: bool = True) -> None:
         super().__init__(crs=crs)
+        self.footprint_distance = footprint_distance
         self.buildings = ()
         self.home_counter = defaultdict(int)
         self._buildings = {}
-        self._commuters_pos_map = defaultdict(set)
+        self._commuter_grid = CommuterGrid()
         self._commuter_id_map = {}
         self.commuters = []
+        self._building_geometries = None
 
     def get_random_building(self) -> Building:
         return random.choice(self.buildings)
@@ -34,14 +49,114 @@ class Netherlands(mg.GeoSpace):
     def get_building_by_id(self, unique_id: int) -> Building:
         return self._buildings[unique_id]
     
-    def get_nearest_building (
-        self, float_pos: mesa.space.FloatCoordinate, visited_locations: list,
-    ) -> Building:
-        search = [x for x in self.buildings if x not in visited_locations]
-        min_building = min(search,key=lambda x:x.geometry.distance(float_pos))
-        return min_building
+    def new_visited_set(self) -> np.ndarray:
+        # one bit per building, indexed by Building.index
+        return np.zeros((len(self.buildings) + 7) // 8, dtype=np.uint8)
 
+    def mark_visited(self, visited: np.ndarray, building: Building) -> None:
+        visited[building.index >> 3] |= 1 << (building.index & 7)
 
+    @timed("get_nearest_building")
+    def get_nearest_building (
+        self, float_pos: Point, visited: np.ndarray,
+    ) -> Building:
+        return self._get_nearest_building(float_pos, visited)
+
+    def _get_nearest_building(self, float_pos: Point, visited: np.ndarray) -> Building:
+        """
+        Nearest building (by footprint or centroid distance) to float_pos
+        whose bit is not set in the visited bitset. Grid cells are visited in rings of
+        increasing distance from the cell of the point clamped to the grid,
+        until no unvisited cell can hold a nearer building.
+        """
+        if self._building_geometries is None:
+            self._build_building_grid()
+        size = self._grid_cell_size
+        columns, rows = self._grid_shape
+        column = min(max(int((float_pos.x - self._grid_origin[0]) // size), 0), columns - 1)
+        row = min(max(int((float_pos.y - self._grid_origin[1]) // size), 0), rows - 1)
+        best_index, best_distance = -1, math.inf
+        for ring in range(max(column, columns - 1 - column, row, rows - 1 - row) + 1):
+            # cells of this and later rings are at least (ring - 1) * size away
+            # from the clamped point, and so from float_pos itself
+            if best_distance < (ring - 1) * size:
+                break
+            cells = [
+                self._grid_cells[(x, y)]
+                for x in range(max(column - ring, 0), min(column + ring, columns - 1) + 1)
+                for y in range(max(row - ring, 0), min(row + ring, rows - 1) + 1)
+                if max(abs(x - column), abs(y - row)) == ring and (x, y) in self._grid_cells
+            ]
+            if not cells:
+                continue
+            # a building overlapping several cells is a candidate once, in index order
+            candidates = np.unique(np.concatenate(cells))
+            candidates = candidates[((visited[candidates >> 3] >> (candidates & 7)) & 1) == 0]
+            if len(candidates) == 0:
+                continue
+            distances = shapely.distance(self._building_geometries[candidates], float_pos)
+            nearest = np.argmin(distances)
+            if distances[nearest] < best_distance or (
+                distances[nearest] == best_distance and candidates[nearest] < best_index
+            ):
+                best_index, best_distance = candidates[nearest], distances[nearest]
+        if best_index < 0:
+            raise ValueError("all buildings have been visited")
+        return self.buildings[best_index]
+
+    def get_building_distance(self, building: Building, float_pos: Point) -> float:
+        # the distance the nearest building query minimizes
+        if self.footprint_distance:
+            return building.geometry.distance(float_pos)
+        return Point(building.centroid).distance(float_pos)
+
+    def _build_building_grid(self) -> None:
+        if self.footprint_distance:
+            self._building_geometries = np.array(
+                [building.geometry for building in self.buildings], dtype=object
+            )
+        else:
+            # the footprints stay unloaded
+            self._building_geometries = shapely.points(
+                [building.centroid for building in self.buildings]
+            )
+        bounds = shapely.bounds(self._building_geometries)
+        min_x, min_y = bounds[:, 0].min(), bounds[:, 1].min()
+        width = max(bounds[:, 2].max() - min_x, 1.0)
+        height = max(bounds[:, 3].max() - min_y, 1.0)
+        # about four buildings per cell
+        size = max(math.sqrt(width * height / len(self.buildings)) * 2, 1.0)
+        self._grid_origin = (min_x, min_y)
+        self._grid_cell_size = size
+        self._grid_shape = (int(width // size) + 1, int(height // size) + 1)
+        cells = defaultdict(list)
+        first = np.floor((bounds[:, :2] - (min_x, min_y)) / size).astype(int)
+        last = np.floor((bounds[:, 2:] - (min_x, min_y)) / size).astype(int)
+        for index, ((x0, y0), (x1, y1)) in enumerate(zip(first, last)):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    cells[(x, y)].append(index)
+        self._grid_cells = {cell: np.array(indices) for cell, indices in cells.items()}
+
+
+
+    def load_buildings(
+        self,
+        model: mesa.Model,
+        unique_ids,
+        centroids: np.ndarray,
+        footprints: BuildingFootprints,
+    ) -> list[Building]:
+        """
+        Create and add the buildings with the given ids and centroids, whose
+        footprints are at the same positions in footprints.
+        """
+        buildings = [
+            Building(unique_id, model, self.crs, centroid, footprints, i)
+            for i, (unique_id, centroid) in enumerate(zip(unique_ids, map(tuple, centroids.tolist())))
+        ]
+        self.add_buildings(buildings, [0] * len(buildings))
+        return buildings
 
     # def add_buildings(self, agents, types) -> None:
     def add_buildings(self, agents, types) -> None:
@@ -49,6 +164,7 @@ class Netherlands(mg.GeoSpace):
         buildings = []
         for (agent,type) in zip(agents,types):
             if isinstance(agent, Building):
+                agent.index = len(self.buildings) + len(buildings)
                 self._buildings[agent.unique_id] = agent
                 if  type == 0:
                     agent.function = 0
@@ -56,11 +172,18 @@ class Netherlands(mg.GeoSpace):
                     agent.function = 1
             buildings.append(agent)
         self.buildings = self.buildings + tuple(buildings)
+        self._building_geometries = None
 
     def get_commuters_by_pos(
         self, float_pos: mesa.space.FloatCoordinate
     ) -> Set[Commuter]:
-        return self._commuters_pos_map[float_pos]
+        return self._commuter_grid.get_commuters_at(float_pos)
+
+    def get_commuters_within(
+        self, float_pos: mesa.space.FloatCoordinate, radius: float
+    ) -> List[Commuter]:
+        """Commuters within radius (in units of the crs) of float_pos, nearest first."""
+        return self._commuter_grid.get_commuters_within(float_pos, radius)
 
     def get_commuter_by_id(self, commuter_id: int) -> Commuter:
         return self._commuter_id_map[commuter_id]
@@ -68,7 +191,7 @@ class Netherlands(mg.GeoSpace):
     def add_commuter(self, agent: Commuter, update_idx: bool) -> None:
         if (update_idx):
             super().add_agents([agent])
-        self._commuters_pos_map[(agent.geometry.x, agent.geometry.y)].add(agent)
+        self._commuter_grid.add(agent, (agent.geometry.x, agent.geometry.y))
         self._commuter_id_map[agent.unique_id] = agent
 
     def update_home_counter(
@@ -83,15 +206,9 @@ class Netherlands(mg.GeoSpace):
     def move_commuter(
         self, commuter: Commuter, pos: mesa.space.FloatCoordinate, update_idx: bool
     ) -> None:
-        self.__remove_commuter(commuter,update_idx)
-        commuter.geometry = Point(pos)
-        self.add_commuter(commuter,update_idx)
-        
-
-    def __remove_commuter(self, commuter: Commuter,update_idx: bool) -> None:
         if (update_idx):
             super().remove_agent(commuter)
-        del self._commuter_id_map[commuter.unique_id]
-        self._commuters_pos_map[(commuter.geometry.x, commuter.geometry.y)].remove(
-            commuter
-        )
+        commuter.geometry = Point(pos)
+        if (update_idx):
+            super().add_agents([commuter])
+        self._commuter_grid.move(commuter, pos)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+BUILDINGS_LAYER = "buildings"
+ROADS_LAYER = "roads"
+
+
+def save_region_snapshot(
+    path: str, buildings_df: gpd.GeoDataFrame, walkway_df: gpd.GeoDataFrame
+) -> None:
+    """
+    Store the buildings and roads of a bounding box, already projected to the
+    model crs, as two layers of a GeoPackage. Loading a snapshot avoids
+    scanning and reprojecting the regional Geofabrik files on every run.
+    The building centroids are stored as columns, so the buildings can be
+    loaded without their footprints.
+    """
+    centroids = buildings_df.centroid
+    buildings_df.assign(centroid_x=centroids.x, centroid_y=centroids.y).to_file(
+        path, layer=BUILDINGS_LAYER, driver="GPKG", index=True
+    )
+    walkway_df[["geometry"]].to_file(path, layer=ROADS_LAYER, driver="GPKG")
+
+
+def load_region_snapshot(
+    path: str, footprints: bool = True
+) -> tuple[pd.DataFrame, gpd.GeoDataFrame]:
+    """
+    Load the buildings and roads of a snapshot. Without footprints, the
+    buildings are a plain frame with their centroid columns, unless the
+    snapshot was written without them.
+    """
+    buildings_df = None
+    if not footprints:
+        buildings_df = gpd.read_file(path, layer=BUILDINGS_LAYER, ignore_geometry=True)
+        if "centroid_x" not in buildings_df:
+            buildings_df = None
+    if buildings_df is None:
+        buildings_df = gpd.read_file(path, layer=BUILDINGS_LAYER)
+    walkway_df = gpd.read_file(path, layer=ROADS_LAYER)
+    return buildings_df.set_index("unique_id"), walkway_df
+
+
+def get_centroids(buildings_df: pd.DataFrame) -> np.ndarray:
+    """The (x, y) centroids of the buildings, from the snapshot columns or the footprints."""
+    if "centroid_x" in buildings_df:
+        return buildings_df[["centroid_x", "centroid_y"]].to_numpy(dtype=float)
+    centroids = buildings_df.centroid
+    return np.column_stack([centroids.x, centroids.y])
+
+
+class BuildingFootprints:
+    """
+    Footprint polygons of buildings by position, either held in memory or
+    left in a region snapshot until they are first needed, e.g. by the
+    visualization or a footprint-aware nearest building query.
+    """
+
+    _geometries: np.ndarray | None
+    _path: str | None
+
+    def __init__(self, geometries: np.ndarray | None = None, path: str | None = None) -> None:
+        if (geometries is None) == (path is None):
+            raise ValueError("Footprints need either geometries or a snapshot path")
+        self._geometries = geometries
+        self._path = path
+
+    @property
+    def loaded(self) -> bool:
+        return self._geometries is not None
+
+    def get_all(self) -> np.ndarray:
+        if self._geometries is None:
+            # in the order of the buildings layer, as the buildings were created
+            self._geometries = gpd.read_file(
+                self._path, layer=BUILDINGS_LAYER, columns=[]
+            ).geometry.to_numpy()
+        return self._geometries
+
+    def __getitem__(self, index: int):
+        return self.get_all()[index]
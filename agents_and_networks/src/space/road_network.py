@@ -1,14 +1,19 @@
 from __future__ import annotations
 
+import multiprocessing
 import pickle
 
 import geopandas as gpd
 import mesa
 import momepy
 import networkx as nx
+import numpy as np
 import pyproj
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
 from sklearn.neighbors import KDTree
 
+from src.metrics import timed
 from src.space.utils import segmented
 
 
@@ -47,6 +52,14 @@ class RoadNetwork:
         node_pos = self._kd_tree.get_arrays()[0][node_index[0, 0]]
         return tuple(node_pos)
 
+    def get_nearest_nodes(
+        self, float_pos: list[mesa.space.FloatCoordinate]
+    ) -> list[mesa.space.FloatCoordinate]:
+        node_index = self._kd_tree.query(float_pos, k=1, return_distance=False)
+        nodes = self._kd_tree.get_arrays()[0]
+        return [tuple(nodes[i]) for i in node_index[:, 0]]
+
+    @timed("get_shortest_path")
     def get_shortest_path(
         self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
     ) -> list[mesa.space.FloatCoordinate]:
@@ -68,14 +81,37 @@ class RoadNetwork:
         return length
 
 
+# road graph shared with the worker processes of NetherlandsWalkway.precompute_paths
+_worker_graph = None
+
+
+def _init_worker(graph: scipy.sparse.csr_matrix) -> None:
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _predecessors(sources: np.ndarray) -> np.ndarray:
+    _, predecessors = dijkstra(
+        _worker_graph, directed=False, indices=sources, return_predecessors=True
+    )
+    return predecessors
+
+
 class NetherlandsWalkway(RoadNetwork):
     _path_select_cache: dict[
         tuple[mesa.space.FloatCoordinate, mesa.space.FloatCoordinate],
         list[mesa.space.FloatCoordinate],
     ]
+    # shortest path trees of the precomputed sources, one predecessor row per source
+    _predecessors: np.ndarray | None
+    _source_rows: dict[mesa.space.FloatCoordinate, int]
+    _node_index: dict[mesa.space.FloatCoordinate, int]
 
     def __init__(self, lines) -> None:
         super().__init__(lines)
+        self._predecessors = None
+        self._source_rows = {}
+        self._node_index = {}
         self._path_cache_result = f"outputs/path_cache_result.pkl"
         try:
             with open(self._path_cache_result, "rb") as cached_result:
@@ -99,4 +135,49 @@ class NetherlandsWalkway(RoadNetwork):
     def get_cached_path(
         self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
     ) -> list[mesa.space.FloatCoordinate] | None:
+        if source in self._source_rows and target in self._node_index:
+            return self._reconstruct_path(source, target)
         return self._path_select_cache.get((source, target), None)
+
+    def precompute_paths(
+        self, sources: list[mesa.space.FloatCoordinate], processes: int | None = None
+    ) -> None:
+        """
+        Compute the shortest path trees from every (entrance) node in sources
+        with Dijkstra, split over processes (all cores by default). Paths
+        from these nodes are then served by get_cached_path from the
+        predecessor rows, in time linear in the path length.
+        """
+        nodes = self._kd_tree.get_arrays()[0]
+        self._node_index = {tuple(node): i for i, node in enumerate(nodes)}
+        # shortest of any parallel edges, in both directions
+        lengths = {}
+        for u, v, data in self.nx_graph.edges(data=True):
+            edge = (self._node_index[u], self._node_index[v])
+            lengths[edge] = min(data["length"], lengths.get(edge, np.inf))
+        rows, columns = np.array(list(lengths.keys())).T
+        graph = scipy.sparse.csr_matrix(
+            (list(lengths.values()), (rows, columns)), shape=(len(nodes), len(nodes))
+        )
+        unique_sources = list(dict.fromkeys(sources))
+        indices = np.array([self._node_index[source] for source in unique_sources])
+        processes = processes or multiprocessing.cpu_count()
+        chunks = np.array_split(indices, min(processes, len(indices)) or 1)
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(graph,)) as pool:
+            predecessors = pool.map(_predecessors, chunks)
+        self._predecessors = np.concatenate(predecessors).astype(np.int32)
+        self._source_rows = {source: row for row, source in enumerate(unique_sources)}
+
+    def _reconstruct_path(
+        self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
+    ) -> list[mesa.space.FloatCoordinate]:
+        nodes = self._kd_tree.get_arrays()[0]
+        predecessors = self._predecessors[self._source_rows[source]]
+        node = self._node_index[target]
+        if predecessors[node] < 0 and source != target:
+            # not in the shortest path tree of the source, as nx.astar_path would report
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+        path = [target]
+        while (node := predecessors[node]) >= 0:
+            path.append(tuple(nodes[node]))
+        return path[::-1]
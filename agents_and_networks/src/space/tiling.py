@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import math
+import random
+import weakref
+from collections import OrderedDict
+
+import geopandas as gpd
+import mesa
+import networkx as nx
+import numpy as np
+from shapely.geometry import Point, box
+
+from src.agent.building import Building
+from src.metrics import METRICS, timed
+from src.space.netherlands import Netherlands
+from src.space.region import BuildingFootprints, get_centroids
+from src.space.road_network import RoadNetwork
+
+
+"""
+Tiled regions: the bounding box is split into square tiles that each hold the buildings and roads
+of the tile plus an overlap on every side. Tiles are read on demand and only the most recently used
+ones are kept in memory, so exploration jumps can cover large regions with bounded memory.
+"""
+
+
+class Tile:
+    key: tuple[int, int]
+    bounds: tuple[float, float, float, float]  # including the overlap
+    space: Netherlands  # buildings of the tile, with their grid index
+    walkway: RoadNetwork | None  # None when no roads fall in the tile
+    _boundary_nodes: dict[tuple[int, int], list[mesa.space.FloatCoordinate]]
+
+    def __init__(self, key, bounds, space, walkway) -> None:
+        self.key = key
+        self.bounds = bounds
+        self.space = space
+        self.walkway = walkway
+        self._boundary_nodes = {}
+
+    def contains(self, float_pos: mesa.space.FloatCoordinate) -> bool:
+        min_x, min_y, max_x, max_y = self.bounds
+        return min_x <= float_pos[0] <= max_x and min_y <= float_pos[1] <= max_y
+
+    def get_boundary_nodes(self, other: Tile) -> list[mesa.space.FloatCoordinate]:
+        # road nodes in the overlap with a neighbouring tile that both road graphs share
+        if other.key not in self._boundary_nodes:
+            other_nodes = other.walkway.nx_graph.nodes
+            self._boundary_nodes[other.key] = [
+                node for node in self.walkway.nx_graph.nodes
+                if other.contains(node) and node in other_nodes
+            ]
+        return self._boundary_nodes[other.key]
+
+
+class TiledNetherlands(Netherlands):
+    """
+    Netherlands space whose buildings are read per tile instead of all at once. Buildings are
+    identified by id_column of the buildings file, which must be stable between reads of
+    overlapping tiles. Visited locations are kept as sets of these ids instead of bitsets.
+    """
+    model: mesa.Model
+    _tiles: OrderedDict[tuple[int, int], Tile]
+    _handed_out: weakref.WeakValueDictionary
+
+    def __init__(
+        self,
+        model: mesa.Model,
+        crs: str,
+        data_crs: str,
+        bounding_box: tuple,
+        buildings_file: str,
+        walkway_file: str,
+        tile_size: float,
+        tile_overlap: float,
+        max_tiles: int = 9,
+        id_column: str = "osm_id",
+        footprint_distance: bool = True,
+    ) -> None:
+        super().__init__(crs=crs, footprint_distance=footprint_distance)
+        self.model = model
+        self.data_crs = data_crs
+        self.buildings_file = buildings_file
+        self.walkway_file = walkway_file
+        self.tile_size = tile_size  # in meters of the model crs
+        self.tile_overlap = tile_overlap
+        self.max_tiles = max_tiles
+        self.id_column = id_column
+        min_x, min_y, max_x, max_y = (
+            gpd.GeoSeries([box(*bounding_box)], crs=data_crs).to_crs(crs).total_bounds
+        )
+        self.origin = (min_x, min_y)
+        self.shape = (
+            max(math.ceil((max_x - min_x) / tile_size), 1),
+            max(math.ceil((max_y - min_y) / tile_size), 1),
+        )
+        self._tiles = OrderedDict()
+        # buildings still referenced by commuters, also after their tile is evicted
+        self._handed_out = weakref.WeakValueDictionary()
+
+    def get_tile_key(self, float_pos: mesa.space.FloatCoordinate) -> tuple[int, int]:
+        # positions outside the region belong to the nearest tile on its edge
+        column = int((float_pos[0] - self.origin[0]) // self.tile_size)
+        row = int((float_pos[1] - self.origin[1]) // self.tile_size)
+        return (
+            min(max(column, 0), self.shape[0] - 1),
+            min(max(row, 0), self.shape[1] - 1),
+        )
+
+    def get_tile(self, key: tuple[int, int]) -> Tile:
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            METRICS.count("tile_hit")
+        else:
+            METRICS.count("tile_miss")
+            self._tiles[key] = self._load_tile(key)
+            if len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return self._tiles[key]
+
+    @timed("load_tile")
+    def _load_tile(self, key: tuple[int, int]) -> Tile:
+        min_x = self.origin[0] + key[0] * self.tile_size - self.tile_overlap
+        min_y = self.origin[1] + key[1] * self.tile_size - self.tile_overlap
+        size = self.tile_size + 2 * self.tile_overlap
+        bounds = (min_x, min_y, min_x + size, min_y + size)
+        area = self._get_data_area(bounds)
+        space = Netherlands(crs=self.crs, footprint_distance=self.footprint_distance)
+        roads_df = self._read_tile_file(self.walkway_file, area)
+        if len(roads_df) == 0:
+            return Tile(key, bounds, space, None)
+        walkway = RoadNetwork(lines=roads_df["geometry"])
+
+        buildings_df = self._read_tile_file(self.buildings_file, area)
+        buildings = space.load_buildings(
+            self.model,
+            buildings_df[self.id_column].tolist(),
+            get_centroids(buildings_df),
+            BuildingFootprints(geometries=buildings_df.geometry.to_numpy()),
+        )
+        entrances = walkway.get_nearest_nodes([building.centroid for building in buildings])
+        for building, entrance_pos in zip(buildings, entrances):
+            building.entrance_pos = entrance_pos
+        return Tile(key, bounds, space, walkway)
+
+    def read_roads(self, first_key: tuple[int, int], last_key: tuple[int, int]) -> RoadNetwork | None:
+        """The road network over the tiles from first_key to last_key, without keeping them."""
+        bounds = (
+            self.origin[0] + min(first_key[0], last_key[0]) * self.tile_size - self.tile_overlap,
+            self.origin[1] + min(first_key[1], last_key[1]) * self.tile_size - self.tile_overlap,
+            self.origin[0] + (max(first_key[0], last_key[0]) + 1) * self.tile_size + self.tile_overlap,
+            self.origin[1] + (max(first_key[1], last_key[1]) + 1) * self.tile_size + self.tile_overlap,
+        )
+        roads_df = self._read_tile_file(self.walkway_file, self._get_data_area(bounds))
+        if len(roads_df) == 0:
+            return None
+        return RoadNetwork(lines=roads_df["geometry"])
+
+    def _get_data_area(self, bounds: tuple) -> tuple:
+        return tuple(gpd.GeoSeries([box(*bounds)], crs=self.crs).to_crs(self.data_crs).total_bounds)
+
+    def _read_tile_file(self, path: str, area: tuple) -> gpd.GeoDataFrame:
+        return (
+            gpd.read_file(path, bbox=area)
+            .set_crs(self.data_crs, allow_override=True)
+            .to_crs(self.crs)
+        )
+
+    def get_random_building(self) -> Building:
+        # a random building of a random tile, tiles without buildings are drawn again
+        while True:
+            tile = self.get_tile((random.randrange(self.shape[0]), random.randrange(self.shape[1])))
+            if tile.space.buildings:
+                return self._hand_out(tile.space.get_random_building())
+
+    def get_building_by_id(self, unique_id) -> Building:
+        if unique_id in self._handed_out:
+            return self._handed_out[unique_id]
+        for tile in self._tiles.values():
+            if unique_id in tile.space._buildings:
+                return self._hand_out(tile.space.get_building_by_id(unique_id))
+        raise KeyError(unique_id)
+
+    def new_visited_set(self) -> set:
+        return set()
+
+    def mark_visited(self, visited: set, building: Building) -> None:
+        visited.add(building.unique_id)
+
+    @timed("get_nearest_building")
+    def get_nearest_building(self, float_pos: Point, visited: set) -> Building:
+        """
+        Nearest unvisited building, searched in rings of tiles around the tile of float_pos. A
+        tile is only read when its area can hold a building nearer than the best one so far, so
+        the search ends once a ring lies entirely beyond that distance.
+        """
+        column, row = self.get_tile_key((float_pos.x, float_pos.y))
+        best, best_distance = None, math.inf
+        for ring in range(max(self.shape)):
+            # tiles of this and later rings are at least (ring - 1) * tile_size away
+            if best_distance <= (ring - 1) * self.tile_size:
+                break
+            for x in range(max(column - ring, 0), min(column + ring, self.shape[0] - 1) + 1):
+                for y in range(max(row - ring, 0), min(row + ring, self.shape[1] - 1) + 1):
+                    if max(abs(x - column), abs(y - row)) != ring:
+                        continue
+                    if self._get_area_distance((x, y), float_pos) >= best_distance:
+                        continue
+                    tile = self.get_tile((x, y))
+                    if not tile.space.buildings:
+                        continue
+                    tile_visited = tile.space.new_visited_set()
+                    for unique_id in visited:
+                        if unique_id in tile.space._buildings:
+                            tile.space.mark_visited(tile_visited, tile.space._buildings[unique_id])
+                    try:
+                        building = tile.space._get_nearest_building(float_pos, tile_visited)
+                    except ValueError:
+                        continue
+                    distance = self.get_building_distance(building, float_pos)
+                    if distance < best_distance:
+                        best, best_distance = building, distance
+        if best is None:
+            raise ValueError("all buildings have been visited")
+        return self._hand_out(best)
+
+    def _get_area_distance(self, key: tuple[int, int], float_pos: Point) -> float:
+        # distance to the area of a tile without its overlap, the tiles on the edge of the
+        # region also own everything beyond it
+        min_x = self.origin[0] + key[0] * self.tile_size if key[0] > 0 else -math.inf
+        min_y = self.origin[1] + key[1] * self.tile_size if key[1] > 0 else -math.inf
+        max_x = self.origin[0] + (key[0] + 1) * self.tile_size if key[0] < self.shape[0] - 1 else math.inf
+        max_y = self.origin[1] + (key[1] + 1) * self.tile_size if key[1] < self.shape[1] - 1 else math.inf
+        dx = max(min_x - float_pos.x, 0.0, float_pos.x - max_x)
+        dy = max(min_y - float_pos.y, 0.0, float_pos.y - max_y)
+        return math.hypot(dx, dy)
+
+    def _hand_out(self, building: Building) -> Building:
+        # the same building read again from another tile is the same agent for commuters
+        if building.unique_id in self._handed_out:
+            return self._handed_out[building.unique_id]
+        # commuters keep buildings after their tile is evicted, so they must not hold on to
+        # the footprints of the whole tile
+        building.keep_own_footprint()
+        self._handed_out[building.unique_id] = building
+        return building
+
+
+class TiledWalkway:
+    """
+    Routes over the road graphs of a TiledNetherlands. Trips within a tile are routed in its graph;
+    longer trips hop tile by tile towards the target, each time to the shared boundary node that
+    minimizes the route length so far plus the straight distance left to the target. When the
+    tiles on the way share no roads, the trip is routed in the roads of all tiles between source
+    and target at once.
+    """
+    _path_select_cache: OrderedDict[
+        tuple[mesa.space.FloatCoordinate, mesa.space.FloatCoordinate],
+        list[mesa.space.FloatCoordinate],
+    ]
+
+    def __init__(self, space: TiledNetherlands, max_cached_paths: int = 100000) -> None:
+        self.space = space
+        self.crs = space.crs
+        self.max_cached_paths = max_cached_paths
+        self._path_select_cache = OrderedDict()
+
+    def cache_path(
+        self,
+        source: mesa.space.FloatCoordinate,
+        target: mesa.space.FloatCoordinate,
+        path: list[mesa.space.FloatCoordinate],
+    ) -> None:
+        self._path_select_cache[(source, target)] = path
+        self._path_select_cache[(target, source)] = list(reversed(path))
+        while len(self._path_select_cache) > self.max_cached_paths:
+            self._path_select_cache.popitem(last=False)
+
+    def get_cached_path(
+        self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
+    ) -> list[mesa.space.FloatCoordinate] | None:
+        return self._path_select_cache.get((source, target), None)
+
+    @timed("get_shortest_path")
+    def get_shortest_path(
+        self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
+    ) -> list[mesa.space.FloatCoordinate]:
+        try:
+            return self._get_hopped_path(source, target)
+        except nx.NetworkXNoPath:
+            # the largest road components of the tiles on the way do not meet
+            return self._get_merged_path(source, target)
+
+    def _get_hopped_path(
+        self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
+    ) -> list[mesa.space.FloatCoordinate]:
+        key = self.space.get_tile_key(source)
+        target_key = self.space.get_tile_key(target)
+        path = []
+        position = source
+        while key != target_key:
+            # one tile along the axis with the most tiles left to go, else along the other axis
+            dx, dy = target_key[0] - key[0], target_key[1] - key[1]
+            next_keys = [(key[0] + int(np.sign(dx)), key[1]), (key[0], key[1] + int(np.sign(dy)))]
+            if abs(dx) < abs(dy):
+                next_keys.reverse()
+            tile = self.space.get_tile(key)
+            if tile.walkway is None:
+                raise nx.NetworkXNoPath(f"no roads in tile {key}")
+            start = tile.walkway.get_nearest_node(position)
+            lengths, paths = nx.single_source_dijkstra(tile.walkway.nx_graph, start, weight="length")
+            for next_key in next_keys:
+                if next_key == key:
+                    continue
+                next_tile = self.space.get_tile(next_key)
+                if next_tile.walkway is None:
+                    continue
+                boundary = [node for node in tile.get_boundary_nodes(next_tile) if node in lengths]
+                if boundary:
+                    break
+            else:
+                raise nx.NetworkXNoPath(f"no shared roads between tile {key} and the next tiles")
+            node = min(boundary, key=lambda node: lengths[node] + math.dist(node, target))
+            path.extend(paths[node][:-1])
+            position, key = node, next_key
+        tile = self.space.get_tile(key)
+        if tile.walkway is None:
+            raise nx.NetworkXNoPath(f"no roads in tile {key}")
+        from_node_pos = tile.walkway.get_nearest_node(position)
+        to_node_pos = tile.walkway.get_nearest_node(target)
+        return path + nx.astar_path(tile.walkway.nx_graph, from_node_pos, to_node_pos, weight="length")
+
+    def _get_merged_path(
+        self, source: mesa.space.FloatCoordinate, target: mesa.space.FloatCoordinate
+    ) -> list[mesa.space.FloatCoordinate]:
+        # route in the roads of all tiles between source and target at once, where components
+        # that are cut off within a single tile can connect
+        walkway = self.space.read_roads(self.space.get_tile_key(source), self.space.get_tile_key(target))
+        if walkway is None:
+            raise nx.NetworkXNoPath(f"no roads between {source} and {target}")
+        from_node_pos = walkway.get_nearest_node(source)
+        to_node_pos = walkway.get_nearest_node(target)
+        return nx.astar_path(walkway.nx_graph, from_node_pos, to_node_pos, weight="length")
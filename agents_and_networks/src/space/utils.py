@@ -8,6 +8,8 @@ from shapely.geometry import LineString, MultiLineString
 from shapely.ops import transform
 import powerlaw as powerlaw
 
+from src.metrics import timed
+
 
 def get_coord_matrix(
     x_min: float, x_max: float, y_min: float, y_max: float
@@ -21,6 +23,7 @@ def get_coord_matrix(
         ]
     )
 
+@timed("power_law_sampling")
 def power_law_exponential_cutoff(
         xmin: float, xmax:float, alpha_beta: float, k: float
 ) -> float:
@@ -0,0 +1,220 @@
+import csv
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+"""
+Optional indexed store for the trajectory and cell outputs: an SQLite file with one table per
+output, indexed on (owner, timestamp) and on timestamp. Any output path ending in .sqlite or .db
+is written to a store instead of a csv file, and read_table reads either, pushing the agent and
+date filters down to the store.
+"""
+
+STORE_SUFFIXES = (".sqlite", ".db")
+
+# timestamps are stored as text in the same format as the csv files
+sqlite3.register_adapter(datetime, str)
+sqlite3.register_adapter(pd.Timestamp, str)
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.float64, float)
+
+
+def is_store(path) -> bool:
+    return str(path).endswith(STORE_SUFFIXES)
+
+
+class OutputStore:
+    connection: sqlite3.Connection
+
+    def __init__(self, path) -> None:
+        # the visualization server steps the model in another thread than the one that built it,
+        # statements on the connection are serialized by the lock instead
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        # the model and the sampler may write to the same store from different threads
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    def create(self, table: str, header: Sequence[str]) -> None:
+        """(Re)create an empty table with the given columns and its indexes."""
+        columns = ", ".join(f'"{column}"' for column in header)
+        with self._lock, self.connection:
+            self.connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+            self.connection.execute(f'CREATE TABLE "{table}" ({columns})')
+            self.connection.execute(f'CREATE INDEX "{table}_owner_timestamp" ON "{table}" (owner, timestamp)')
+            self.connection.execute(f'CREATE INDEX "{table}_timestamp" ON "{table}" (timestamp)')
+
+    def write(self, table: str, rows: Iterable[Sequence]) -> None:
+        rows = list(rows)
+        if not rows:
+            return
+        placeholders = ", ".join("?" * len(rows[0]))
+        with self._lock, self.connection:
+            self.connection.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows)
+
+    def delete_after(self, table: str, timestamp: str) -> int:
+        """Drop the rows at or after the timestamp, return the first free id."""
+        with self._lock:
+            with self.connection:
+                self.connection.execute(f'DELETE FROM "{table}" WHERE timestamp >= ?', (timestamp,))
+            return self.connection.execute(f'SELECT COALESCE(MAX(id) + 1, 0) FROM "{table}"').fetchone()[0]
+
+    def has_table(self, table: str) -> bool:
+        with self._lock:
+            return self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone() is not None
+
+    def delete_from(self, table: str, first_id: int) -> None:
+        # drops the rows written after a checkpoint
+        with self._lock, self.connection:
+            self.connection.execute(f'DELETE FROM "{table}" WHERE id >= ?', (first_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+
+def delete_csv_after(path, timestamp: str, chunk_size: int = 1_000_000) -> int:
+    """Drop the rows at or after the timestamp from a csv file, return the first free id."""
+    next_id = 0
+    with open(str(path) + ".tmp", 'w') as output:
+        pd.read_csv(path, nrows=0).to_csv(output, index=False)
+        # rows are kept as text, so the values are written back unchanged
+        for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunk_size):
+            chunk = chunk.loc[chunk['timestamp'] < timestamp]
+            if len(chunk) > 0:
+                next_id = max(next_id, int(chunk['id'].astype(int).max()) + 1)
+            chunk.to_csv(output, index=False, header=False)
+    os.replace(str(path) + ".tmp", path)
+    return next_id
+
+
+class RowWriter:
+    """
+    Writes rows under a header to a csv file, or to a table of a store for store paths.
+    With truncate_at, existing rows at or after that timestamp are dropped and new rows are
+    appended after the others, numbered from next_id on.
+    """
+
+    def __init__(self, path, table: str, header: Sequence[str], truncate_at: Optional[str] = None) -> None:
+        self.table = table
+        self.next_id = 0
+        if is_store(path):
+            self.store = OutputStore(path)
+            if truncate_at is not None and self.store.has_table(table):
+                self.next_id = self.store.delete_after(table, truncate_at)
+            else:
+                self.store.create(table, header)
+        else:
+            self.store = None
+            if truncate_at is not None and os.path.exists(path):
+                self.next_id = delete_csv_after(path, truncate_at)
+                self.file = open(path, 'a')
+                self.writer = csv.writer(self.file)
+            else:
+                self.file = open(path, 'w')
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(header)
+
+    def writerows(self, rows: Iterable[Sequence]) -> None:
+        if self.store is not None:
+            self.store.write(self.table, rows)
+        else:
+            self.writer.writerows(rows)
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
+        else:
+            self.file.close()
+
+
+def get_tagged_path(path, tag: str) -> str:
+    """The csv file of a tag next to path, stores keep every tag in a table of their own."""
+    if is_store(path):
+        return str(path)
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}_{tag}{path.suffix}"))
+
+
+class TaggedRowWriter:
+    """
+    Writes rows that carry a tag in their last column to one output per tag,
+    a csv file named after the tag next to path, or table_tag in a store.
+    The ids in the first column are numbered per output.
+    """
+
+    def __init__(
+        self, path, table: str, header: Sequence[str], tags: Iterable[str], truncate_at: Optional[str] = None
+    ) -> None:
+        self.writers = {
+            tag: RowWriter(
+                get_tagged_path(path, tag), f"{table}_{tag}" if is_store(path) else table, header, truncate_at
+            )
+            for tag in tags
+        }
+        self.next_ids = {tag: writer.next_id for tag, writer in self.writers.items()}
+        self.next_id = 0
+
+    def writerows(self, rows: Iterable[Sequence]) -> None:
+        by_tag = {tag: [] for tag in self.writers}
+        for row in rows:
+            tag_rows = by_tag[row[-1]]
+            tag_rows.append([self.next_ids[row[-1]] + len(tag_rows), *row[1:-1]])
+        for tag, tag_rows in by_tag.items():
+            self.writers[tag].writerows(tag_rows)
+            self.next_ids[tag] += len(tag_rows)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+
+
+def read_table(
+    path,
+    table: str,
+    agents: Optional[Sequence[str]] = None,
+    date_ranges: Optional[Sequence[tuple[str, str]]] = None,
+    chunk_size: int = 1_000_000,
+) -> pd.DataFrame:
+    """
+    Read the rows of the given agents (owners) within any of the (start, end) date ranges, both
+    inclusive and compared as timestamp text, from a store table or a csv file. Csv files are
+    read in chunks and filtered before the timestamps are parsed.
+    """
+    if is_store(path):
+        conditions, params = [], []
+        if agents is not None:
+            conditions.append(f"owner IN ({', '.join('?' * len(agents))})")
+            params.extend(agents)
+        if date_ranges is not None:
+            conditions.append("(" + " OR ".join(["(timestamp >= ? AND timestamp <= ?)"] * len(date_ranges)) + ")")
+            params.extend(date for date_range in date_ranges for date in date_range)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        connection = sqlite3.connect(Path(path))
+        try:
+            return pd.read_sql_query(f'SELECT * FROM "{table}"{where} ORDER BY rowid', connection, params=params)
+        finally:
+            connection.close()
+
+    selected = []
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        mask = np.ones(len(chunk), dtype=bool)
+        if agents is not None:
+            mask &= chunk['owner'].isin(agents)
+        if date_ranges is not None:
+            in_range = np.zeros(len(chunk), dtype=bool)
+            for start, end in date_ranges:
+                in_range |= (chunk['timestamp'] >= start) & (chunk['timestamp'] <= end)
+            mask &= in_range
+        selected.append(chunk.loc[mask])
+    if not selected:
+        return pd.read_csv(path, nrows=0)
+    return pd.concat(selected, ignore_index=True)
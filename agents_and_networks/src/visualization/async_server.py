@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import mesa
+import tornado.escape
+import tornado.ioloop
+from mesa.visualization.ModularVisualization import SocketHandler
+
+
+class AsyncSocketHandler(SocketHandler):
+    """
+    Socket of an AsyncModularServer. The page tells when it starts and stops running: step requests
+    of a running page keep the background run going, the snapshots are pushed by the server at its
+    own frame rate. A step request of a page that is not running steps the model once.
+    """
+
+    running = False
+
+    def open(self):
+        super().open()
+        self.application.sockets.add(self)
+
+    def on_close(self):
+        self.application.sockets.discard(self)
+        self.application.update_run()
+
+    def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        if msg["type"] == "start":
+            self.running = True
+        elif msg["type"] == "stop":
+            self.running = False
+            self.application.update_run()
+        elif msg["type"] == "get_step":
+            if not self.application.model.running:
+                self.write_message({"type": "end"})
+            elif self.running:
+                self.application.update_run()
+            else:
+                self.application.step()
+        else:
+            super().on_message(message)
+
+
+class AsyncModularServer(mesa.visualization.ModularServer):
+    """
+    ModularServer that steps the model in a background thread at full speed while a page is
+    running. The visualization elements render a snapshot frame_rate times per second, which is
+    pushed to every open page. The run stops as soon as no page is running or the model is reset.
+    """
+
+    def __init__(self, *args, frame_rate=10, **kwargs):
+        # used by reset_model, which the ModularServer constructor calls
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stop = threading.Event()
+        self._rendered_steps = None
+        self.sockets = set()
+        self.frame_rate = frame_rate
+        super().__init__(*args, **kwargs)
+        for rule in self.wildcard_router.rules:
+            if rule.target is SocketHandler:
+                rule.target = AsyncSocketHandler
+        with open(os.path.dirname(__file__) + "/templates/AsyncRunControl.js") as js_file:
+            self.js_code.append(js_file.read())
+
+    def update_run(self):
+        """Run the model in the background while a page is running, stop it otherwise."""
+        if any(socket.running for socket in self.sockets):
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        else:
+            self._stop_run()
+
+    def step(self):
+        """Step the model once and push the snapshot."""
+        with self._lock:
+            if self.model.running:
+                self.model.step()
+        self._push_snapshot()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                if not self.model.running:
+                    break
+                self.model.step()
+            # let the frame loop take the lock between steps
+            time.sleep(0)
+
+    def _stop_run(self):
+        if self._worker is not None:
+            self._stop.set()
+            self._worker.join()
+            self._stop.clear()
+            self._worker = None
+
+    def reset_model(self):
+        self._stop_run()
+        with self._lock:
+            # the ModularServer constructor resets before there is a model
+            model = getattr(self, "model", None)
+            if model is not None and hasattr(model, "close"):
+                model.close()
+            super().reset_model()
+            self._rendered_steps = self.model.schedule.steps
+
+    def render_model(self):
+        with self._lock:
+            return super().render_model()
+
+    def _push_snapshot(self):
+        # only frames with new steps, so a paused run costs nothing
+        if not self.sockets or self.model.schedule.steps == self._rendered_steps:
+            return
+        self._rendered_steps = self.model.schedule.steps
+        messages = [{"type": "viz_state", "data": self.render_model()}]
+        if not self.model.running:
+            messages.append({"type": "end"})
+        for socket in list(self.sockets):
+            for message in messages:
+                socket.write_message(message)
+
+    def launch(self, port=None, open_browser=True):
+        tornado.ioloop.PeriodicCallback(self._push_snapshot, 1000 / self.frame_rate).start()
+        super().launch(port, open_browser)
@@ -0,0 +1,112 @@
+import os
+from collections import Counter, defaultdict
+
+import mesa
+import mesa_geo as mg
+import numpy as np
+from pyproj import Transformer
+from shapely import MultiLineString, line_merge
+
+from src.visualization.server import agent_draw
+
+
+class CommuterMapModule(mesa.visualization.VisualizationElement):
+    """
+    Leaflet map that streams commuters only. Roads (and buildings, for small regions) are sent
+    once per model as a static layer, after that every frame carries only the commuters whose
+    position or color changed. Above max_commuters, commuters are sent as clusters on a grid of
+    cluster_size meters instead.
+
+    :param portrayal_method: returns the portrayal of a commuter, only its "color" is used
+    :param max_commuters: number of commuters above which they are clustered
+    :param cluster_size: size of the cluster grid cells, in meters of the model crs
+    :param max_buildings: number of buildings above which footprints are left out of the static layer
+    :param simplify_tolerance: tolerance of the static geometries, in meters of the model crs
+    """
+    local_includes = ["css/external/leaflet.css", "js/external/leaflet.js"]
+    local_dir = os.path.dirname(mg.visualization.__file__) + "/templates"
+
+    def __init__(
+        self,
+        portrayal_method=agent_draw,
+        map_width=500,
+        map_height=500,
+        max_commuters=2000,
+        cluster_size=250,
+        max_buildings=5000,
+        simplify_tolerance=2.0,
+    ):
+        super().__init__()
+        self.portrayal_method = portrayal_method
+        self.max_commuters = max_commuters
+        self.cluster_size = cluster_size
+        self.max_buildings = max_buildings
+        self.simplify_tolerance = simplify_tolerance
+        with open(os.path.dirname(__file__) + "/templates/CommuterMapModule.js") as js_file:
+            self.js_code = js_file.read() + f"elements.push(new CommuterMapModule({map_width}, {map_height}));"
+        self._model = None
+        self._sent = {}
+
+    def render(self, model):
+        static = None
+        if model is not self._model:
+            # a new (or reset) model, its page starts from an empty map
+            self._model = model
+            self._sent = {}
+            self._transformer = Transformer.from_crs(model.space.crs, "epsg:4326", always_xy=True)
+            static = self._render_static(model)
+        commuters = model.schedule.agents
+        x = np.array([commuter.geometry.x for commuter in commuters])
+        y = np.array([commuter.geometry.y for commuter in commuters])
+        colors = [self.portrayal_method(commuter)["color"] for commuter in commuters]
+        if len(commuters) > self.max_commuters:
+            # individual markers are rebuilt once commuters drop below the limit again
+            self._sent = {}
+            return {"static": static, "clusters": self._render_clusters(x, y, colors), "commuters": {}, "removed": []}
+        lon, lat = self._transformer.transform(x, y)
+        changed = {}
+        current = {}
+        for commuter, point_lat, point_lon, color in zip(commuters, lat, lon, colors):
+            state = (round(point_lat, 6), round(point_lon, 6), color)
+            current[commuter.index] = state
+            if self._sent.get(commuter.index) != state:
+                changed[commuter.index] = state
+        removed = [index for index in self._sent if index not in current]
+        self._sent = current
+        return {"static": static, "clusters": None, "commuters": changed, "removed": removed}
+
+    def _render_clusters(self, x, y, colors) -> list:
+        cells = defaultdict(list)
+        for i, cell in enumerate(zip(x // self.cluster_size, y // self.cluster_size)):
+            cells[cell].append(i)
+        clusters = []
+        for members in cells.values():
+            lon, lat = self._transformer.transform(x[members].mean(), y[members].mean())
+            color = Counter(colors[i] for i in members).most_common(1)[0][0]
+            clusters.append([round(lat, 6), round(lon, 6), len(members), color])
+        return clusters
+
+    def _render_static(self, model) -> dict:
+        roads = []
+        if hasattr(model.walkway, "nx_graph"):
+            # the segmented road graph merged back into simplified lines
+            merged = line_merge(MultiLineString(list(model.walkway.nx_graph.edges())))
+            lines = getattr(merged, "geoms", [merged])
+            roads = [self._latlon(line.simplify(self.simplify_tolerance).coords) for line in lines]
+        buildings = []
+        if len(model.space.buildings) <= self.max_buildings:
+            buildings = [
+                self._latlon(building.geometry.exterior.simplify(self.simplify_tolerance).coords)
+                for building in model.space.buildings
+                if building.geometry.geom_type == "Polygon"
+            ]
+        bounds = []
+        if roads:
+            points = np.concatenate([np.array(road) for road in roads])
+            bounds = [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+        return {"roads": roads, "buildings": buildings, "bounds": bounds}
+
+    def _latlon(self, coords) -> list:
+        x, y = np.array(coords).T
+        lon, lat = self._transformer.transform(x, y)
+        return np.round(np.column_stack([lat, lon]), 6).tolist()
@@ -0,0 +1,12 @@
+// Tell the AsyncModularServer when the page starts and stops running. Step requests of a running
+// page keep the background run going, a lone step request steps the model once.
+const startRun = controller.start;
+const stopRun = controller.stop;
+controller.start = function () {
+    send({ type: "start" });
+    startRun.call(this);
+};
+controller.stop = function () {
+    send({ type: "stop" });
+    stopRun.call(this);
+};
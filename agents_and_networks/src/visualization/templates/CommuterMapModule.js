@@ -0,0 +1,81 @@
+const CommuterMapModule = function (map_width, map_height) {
+    // Create the map tag
+    const map_tag = document.createElement("div");
+    map_tag.style.width = map_width + "px";
+    map_tag.style.height = map_height + "px";
+    map_tag.style.border = "1px dotted";
+    map_tag.id = "commutermapid"
+
+    // Append it to #elements
+    const elements = document.getElementById("elements");
+    elements.appendChild(map_tag);
+
+    // Canvas rendering keeps thousands of markers responsive
+    const Lmap = L.map('commutermapid', {zoomSnap: 0.1, preferCanvas: true})
+    L.tileLayer("https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png", {
+        attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors',
+    }).addTo(Lmap)
+
+    let staticLayer = L.layerGroup().addTo(Lmap)
+    let clusterLayer = L.layerGroup().addTo(Lmap)
+    let commuterLayer = L.layerGroup().addTo(Lmap)
+    let markers = {}
+
+    this.renderStatic = function (layer) {
+        L.polyline(layer.roads, {color: "#04D0CD", weight: 1, interactive: false}).addTo(staticLayer)
+        if (layer.buildings.length !== 0) {
+            L.polygon(layer.buildings, {color: "Grey", weight: 0.5, interactive: false}).addTo(staticLayer)
+        }
+        if (layer.bounds.length !== 0) {
+            Lmap.fitBounds(layer.bounds)
+        }
+    }
+
+    this.renderCommuters = function (commuters, removed) {
+        for (const index in commuters) {
+            const [lat, lon, color] = commuters[index]
+            if (index in markers) {
+                markers[index].setLatLng([lat, lon])
+                markers[index].setStyle({color: color, fillColor: color})
+            } else {
+                markers[index] = L.circleMarker([lat, lon], {
+                    radius: 5, color: color, fillColor: color, fillOpacity: 1,
+                }).addTo(commuterLayer)
+            }
+        }
+        removed.forEach(function (index) {
+            markers[index].remove()
+            delete markers[index]
+        })
+    }
+
+    this.renderClusters = function (clusters) {
+        clusterLayer.clearLayers()
+        clusters.forEach(function ([lat, lon, count, color]) {
+            L.circleMarker([lat, lon], {
+                radius: 3 + 2 * Math.sqrt(count), color: color, fillColor: color, fillOpacity: 0.6,
+            }).bindTooltip(String(count)).addTo(clusterLayer)
+        })
+    }
+
+    this.render = function (data) {
+        if (data.static !== null) {
+            this.renderStatic(data.static)
+        }
+        if (data.clusters !== null) {
+            commuterLayer.clearLayers()
+            markers = {}
+            this.renderClusters(data.clusters)
+        } else {
+            clusterLayer.clearLayers()
+            this.renderCommuters(data.commuters, data.removed)
+        }
+    }
+
+    this.reset = function () {
+        staticLayer.clearLayers()
+        clusterLayer.clearLayers()
+        commuterLayer.clearLayers()
+        markers = {}
+    }
+}
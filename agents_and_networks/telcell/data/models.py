@@ -1,10 +1,12 @@
 from __future__ import annotations
 import math
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import cached_property
-from typing import Any, Mapping, Tuple, Sequence, Iterator, Union
+from typing import Any, List, Mapping, Tuple, Sequence, Iterator, Union
 
+import numpy as np
+import pandas as pd
 import pyproj
 from pyproj import Proj, Geod, Transformer
 
@@ -26,6 +28,8 @@ RD_TO_WGS84 = Transformer.from_proj(rd_projection, wgs84_projection)
 rd_x_range = (1000, 350000)
 rd_y_range = (1000, 700000)
 GEOD_WGS84 = pyproj.Geod(ellps='WGS84')
+# Columns of the sampled cell output that are stored as measurement extras
+CELL_CSV_EXTRA = {'cellinfo.azimuth_degrees': 'azimuth', 'cell': 'cell'}
 
 
 def approximately_equal(first, second, tolerance=.0001):
@@ -97,6 +101,119 @@ class Point:
         return f'Point(lat={self.lat}, lon={self.lon})'
 
 
+@dataclass(frozen=True, eq=False)
+class RDPointArray:
+    """
+    An array of rijksdriehoek coordinates, the vectorized counterpart of
+    `RDPoint`.
+
+    :param x: The x coordinates
+    :param y: The y coordinates, of the same length as `x`
+    """
+    x: np.ndarray
+    y: np.ndarray
+
+    def __post_init__(self):
+        x = np.asarray(self.x, dtype=float)
+        y = np.asarray(self.y, dtype=float)
+        if x.shape != y.shape:
+            raise ValueError(f'Shapes of x and y differ: {x.shape} and {y.shape}.')
+        invalid = (x < rd_x_range[0]) | (x > rd_x_range[1]) | \
+                  (y < rd_y_range[0]) | (y > rd_y_range[1])
+        if invalid.any():
+            i = np.flatnonzero(invalid)[0]
+            raise ValueError(f'Invalid rijksdriehoek coordinates at index {i}: '
+                             f'(x={x.flat[i]}, y={y.flat[i]}); '
+                             f'allowed range: x={rd_x_range}, y={rd_y_range}.')
+        object.__setattr__(self, 'x', x)
+        object.__setattr__(self, 'y', y)
+
+    @classmethod
+    def from_points(cls, points: Sequence[RDPoint]) -> RDPointArray:
+        return cls(x=[point.x for point in points], y=[point.y for point in points])
+
+    @property
+    def xy(self) -> np.ndarray:
+        return np.stack([self.x, self.y], axis=-1)
+
+    def convert_to_wgs84(self) -> PointArray:
+        lon, lat = RD_TO_WGS84.transform(self.x, self.y)
+        return PointArray(lat=lat, lon=lon)
+
+    def distance(self, other: Union[RDPointArray, PointArray, RDPoint, Point]) -> np.ndarray:
+        """Calculate the element-wise distances (in meters), broadcasting
+        single points over the whole array."""
+        other_rd = other.convert_to_rd() if isinstance(other, (Point, PointArray)) else other
+        return np.hypot(self.x - other_rd.x, self.y - other_rd.y)
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def __getitem__(self, item: int) -> RDPoint:
+        return RDPoint(x=float(self.x[item]), y=float(self.y[item]))
+
+    def __iter__(self) -> Iterator[RDPoint]:
+        return (RDPoint(x=x, y=y) for x, y in zip(self.x.tolist(), self.y.tolist()))
+
+    def __repr__(self):
+        return f'RDPointArray(x={self.x}, y={self.y})'
+
+
+@dataclass(frozen=True, eq=False)
+class PointArray:
+    """
+    An array of WGS84 coordinates, the vectorized counterpart of `Point`.
+    Conversions and distances push all coordinates through pyproj at once.
+
+    :param lat: The latitudes
+    :param lon: The longitudes, of the same length as `lat`
+    """
+    lat: np.ndarray
+    lon: np.ndarray
+
+    def __post_init__(self):
+        lat = np.asarray(self.lat, dtype=float)
+        lon = np.asarray(self.lon, dtype=float)
+        if lat.shape != lon.shape:
+            raise ValueError(f'Shapes of lat and lon differ: {lat.shape} and {lon.shape}.')
+        invalid = (lat < -90) | (lat > 90) | (lon < -180) | (lon > 180)
+        if invalid.any():
+            i = np.flatnonzero(invalid)[0]
+            raise ValueError(f'Invalid wgs84 coordinates at index {i}: '
+                             f'(lat={lat.flat[i]}, lon={lon.flat[i]}).')
+        object.__setattr__(self, 'lat', lat)
+        object.__setattr__(self, 'lon', lon)
+
+    @classmethod
+    def from_points(cls, points: Sequence[Point]) -> PointArray:
+        return cls(lat=[point.lat for point in points], lon=[point.lon for point in points])
+
+    @property
+    def latlon(self) -> np.ndarray:
+        return np.stack([self.lat, self.lon], axis=-1)
+
+    def convert_to_rd(self) -> RDPointArray:
+        x, y = WGS84_TO_RD.transform(self.lon, self.lat)
+        return RDPointArray(x=x, y=y)
+
+    def distance(self, other: Union[RDPointArray, PointArray, RDPoint, Point]) -> np.ndarray:
+        """Calculate the element-wise distances (in meters), broadcasting
+        single points over the whole array."""
+        return self.convert_to_rd().distance(other)
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def __getitem__(self, item: int) -> Point:
+        return Point(lat=float(self.lat[item]), lon=float(self.lon[item]))
+
+    def __iter__(self) -> Iterator[Point]:
+        return (Point(lat=lat, lon=lon) for lat, lon in zip(self.lat.tolist(), self.lon.tolist()))
+
+    def __repr__(self):
+        return f'PointArray(lat={self.lat}, lon={self.lon})'
+
+
 @dataclass(eq=True, frozen=True)
 class Measurement:
     """
@@ -156,6 +273,110 @@ class Track:
         return iter(self.measurements)
 
 
+@dataclass(frozen=True, eq=False)
+class CategoricalColumn:
+    """
+    A dictionary-encoded column of measurement metadata.
+
+    :param categories: The distinct values of the column
+    :param codes: For every row the index into `categories`, or -1 if the
+            value is missing
+    """
+    categories: np.ndarray
+    codes: np.ndarray
+
+    @classmethod
+    def from_values(cls, values: Sequence[Any]) -> CategoricalColumn:
+        codes, categories = pd.factorize(np.asarray(values, dtype=object))
+        return cls(categories=np.asarray(categories, dtype=object),
+                   codes=codes.astype(np.int32))
+
+    def take(self, indices: np.ndarray) -> CategoricalColumn:
+        return CategoricalColumn(categories=self.categories, codes=self.codes[indices])
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, item: int) -> Any:
+        code = self.codes[item]
+        return None if code < 0 else self.categories[code]
+
+
+@dataclass(eq=False)
+class ColumnarTrack:
+    """
+    A history of measurements for a single device, stored column-wise. It
+    behaves like a `Track`, but only materializes `Measurement` objects when
+    they are accessed.
+
+    :param owner: The owner of the device. Can be anything with a simcard.
+    :param device: The name of the device.
+    :param timestamps: Microseconds since the Unix epoch as int64, ordered
+    :param coords: The WGS84 coordinates of the measurements
+    :param extra: Dictionary-encoded metadata columns by name
+    """
+    owner: str
+    device: str
+    timestamps: np.ndarray
+    coords: PointArray
+    extra: Mapping[str, CategoricalColumn]
+
+    def __post_init__(self):
+        self.timestamps = np.asarray(self.timestamps, dtype=np.int64)
+        if len(self.timestamps) != len(self.coords) or \
+                any(len(column) != len(self.timestamps) for column in self.extra.values()):
+            raise ValueError('All columns of a track must have the same length.')
+
+    @classmethod
+    def from_frame(cls, owner: str, device: str, df: pd.DataFrame,
+                   extra_columns: Mapping[str, str] = CELL_CSV_EXTRA) -> ColumnarTrack:
+        """
+        Build a track from a data frame in the `output_cell.csv` layout. The
+        rows are sorted by timestamp.
+
+        :param extra_columns: Maps data frame columns to extra names
+        """
+        df = df.sort_values('timestamp', kind='stable')
+        timestamps = pd.to_datetime(df['timestamp'], format='ISO8601').to_numpy().astype('datetime64[us]')
+        return cls(owner=owner,
+                   device=device,
+                   timestamps=timestamps.astype(np.int64),
+                   coords=PointArray(lat=df['cellinfo.wgs84.lat'].to_numpy(),
+                                     lon=df['cellinfo.wgs84.lon'].to_numpy()),
+                   extra={name: CategoricalColumn.from_values(df[column].to_numpy())
+                          for column, name in extra_columns.items() if column in df})
+
+    @classmethod
+    def from_cell_csv(cls, path: str) -> List[ColumnarTrack]:
+        """Read all tracks from a file in the `output_cell.csv` layout, one
+        per device."""
+        df = pd.read_csv(path, dtype={'owner': str, 'device': str, 'cell': str})
+        return [cls.from_frame(owner, device, device_df)
+                for (owner, device), device_df in df.groupby(['owner', 'device'], sort=True)]
+
+    @property
+    def datetimes(self) -> np.ndarray:
+        return self.timestamps.astype('datetime64[us]')
+
+    @property
+    def measurements(self) -> Sequence[Measurement]:
+        return [self[i] for i in range(len(self))]
+
+    def to_track(self) -> Track:
+        return Track(owner=self.owner, device=self.device, measurements=self.measurements)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, item: int) -> Measurement:
+        return Measurement(coords=self.coords[item],
+                           timestamp=self.datetimes[item].item(),
+                           extra={name: column[item] for name, column in self.extra.items()})
+
+    def __iter__(self) -> Iterator[Measurement]:
+        return (self[i] for i in range(len(self)))
+
+
 @dataclass(order=False, frozen=True, eq=True)
 class MeasurementPair:
     """
@@ -184,3 +405,66 @@ class MeasurementPair:
 
     def __str__(self):
         return f"<{self.measurement_a}, ({self.measurement_b})>"
+
+
+@dataclass(eq=False)
+class MeasurementPairs:
+    """
+    All pairs of measurements of two columnar tracks that lie within a
+    maximum time difference of each other, the bulk counterpart of
+    `MeasurementPair`. Time differences and distances are computed for all
+    pairs at once.
+
+    :param track_a: The track the first measurement of each pair comes from
+    :param track_b: The track the second measurement of each pair comes from
+    :param index_a: For every pair the index of its measurement in `track_a`
+    :param index_b: For every pair the index of its measurement in `track_b`
+    """
+    track_a: ColumnarTrack
+    track_b: ColumnarTrack
+    index_a: np.ndarray
+    index_b: np.ndarray
+
+    @classmethod
+    def within(cls, track_a: ColumnarTrack, track_b: ColumnarTrack,
+               max_time_difference: timedelta) -> MeasurementPairs:
+        """Build all pairs whose time difference is at most
+        `max_time_difference`, using a sorted merge on the timestamps."""
+        window = max_time_difference // timedelta(microseconds=1)
+        order_b = np.argsort(track_b.timestamps, kind='stable')
+        timestamps_b = track_b.timestamps[order_b]
+        start = np.searchsorted(timestamps_b, track_a.timestamps - window, side='left')
+        stop = np.searchsorted(timestamps_b, track_a.timestamps + window, side='right')
+        counts = stop - start
+        index_a = np.repeat(np.arange(len(track_a)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        index_b = order_b[np.repeat(start, counts) + offsets]
+        return cls(track_a=track_a, track_b=track_b, index_a=index_a, index_b=index_b)
+
+    @cached_property
+    def time_differences(self) -> np.ndarray:
+        """Calculate the absolute time differences between the measurements
+        as timedelta64 values."""
+        return np.abs(self.track_a.timestamps[self.index_a]
+                      - self.track_b.timestamps[self.index_b]).astype('timedelta64[us]')
+
+    @cached_property
+    def distances(self) -> np.ndarray:
+        """Calculate the distances (in meters) between the two measurements of
+        every pair."""
+        coords_a, coords_b = self.track_a.coords, self.track_b.coords
+        _, _, distances = GEOD_WGS84.inv(coords_a.lon[self.index_a],
+                                         coords_a.lat[self.index_a],
+                                         coords_b.lon[self.index_b],
+                                         coords_b.lat[self.index_b])
+        return np.asarray(distances)
+
+    def __len__(self) -> int:
+        return len(self.index_a)
+
+    def __getitem__(self, item: int) -> MeasurementPair:
+        return MeasurementPair(self.track_a[self.index_a[item]],
+                               self.track_b[self.index_b[item]])
+
+    def __iter__(self) -> Iterator[MeasurementPair]:
+        return (self[i] for i in range(len(self)))